@@ -1,8 +1,21 @@
 import sqlite3
 import pandas as pd
+import openpyxl
 import os
 from datetime import datetime
 
+# Сколько строк читать из базы за один раз при экспорте
+EXPORT_CHUNK_SIZE = 10000
+
+# Поля, которые разрешено редактировать из консоли
+USER_FIELDS = ('name', 'company_name', 'inn', 'phone', 'email', 'role')
+STOCK_FIELDS = ('sku', 'tyre_size', 'tyre_pattern', 'brand', 'country', 'qty_available',
+                'retail_price', 'wholesale_price', 'warehouse_location')
+
+# Готовые UPDATE-запросы: текст не собирается заново при каждом вызове
+USER_UPDATES = {field: f"UPDATE users SET {field} = ? WHERE id = ?" for field in USER_FIELDS}
+STOCK_UPDATES = {field: f"UPDATE stock SET {field} = ? WHERE id = ?" for field in STOCK_FIELDS}
+
 class AdminConsole:
     def __init__(self, db_path='tyreterra.db'):
         self.db_path = db_path
@@ -16,22 +29,29 @@ class AdminConsole:
         return df
     
     def show_stock(self):
-        """Показать весь склад"""
-        df = pd.read_sql("""
+        """Показать весь склад (печатается частями, без загрузки всей таблицы)"""
+        chunks = pd.read_sql("""
             SELECT s.*, u.name, u.company_name 
             FROM stock s 
             JOIN users u ON s.user_id = u.id 
             ORDER BY s.date DESC
-        """, self.conn)
+        """, self.conn, chunksize=EXPORT_CHUNK_SIZE)
         print("\n📦 СКЛАД:")
-        print(df.to_string(index=False))
-        return df
+        total = 0
+        for i, chunk in enumerate(chunks):
+            print(chunk.to_string(index=False, header=(i == 0)))
+            total += len(chunk)
+        return total
     
     def edit_user(self, user_id, field, value):
         """Редактировать пользователя"""
+        query = USER_UPDATES.get(field)
+        if query is None:
+            print(f"❌ Недопустимое поле: {field}. Доступны: {', '.join(USER_FIELDS)}")
+            return
         try:
             cursor = self.conn.cursor()
-            cursor.execute(f"UPDATE users SET {field} = ? WHERE id = ?", (value, user_id))
+            cursor.execute(query, (value, user_id))
             self.conn.commit()
             print(f"✅ Пользователь #{user_id} обновлен: {field} = {value}")
         except Exception as e:
@@ -39,9 +59,13 @@ class AdminConsole:
     
     def edit_stock(self, stock_id, field, value):
         """Редактировать запись склада"""
+        query = STOCK_UPDATES.get(field)
+        if query is None:
+            print(f"❌ Недопустимое поле: {field}. Доступны: {', '.join(STOCK_FIELDS)}")
+            return
         try:
             cursor = self.conn.cursor()
-            cursor.execute(f"UPDATE stock SET {field} = ? WHERE id = ?", (value, stock_id))
+            cursor.execute(query, (value, stock_id))
             self.conn.commit()
             print(f"✅ Запись склада #{stock_id} обновлена: {field} = {value}")
         except Exception as e:
@@ -50,12 +74,12 @@ class AdminConsole:
     def delete_user(self, user_id):
         """Удалить пользователя"""
         try:
-            cursor = self.conn.cursor()
-            # Сначала удаляем товары пользователя
-            cursor.execute("DELETE FROM stock WHERE user_id = ?", (user_id,))
-            # Затем удаляем пользователя
-            cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
-            self.conn.commit()
+            # Обе операции в одной транзакции: при ошибке откатываются вместе
+            with self.conn:
+                # Сначала удаляем товары пользователя
+                self.conn.execute("DELETE FROM stock WHERE user_id = ?", (user_id,))
+                # Затем удаляем пользователя
+                self.conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
             print(f"✅ Пользователь #{user_id} и его товары удалены")
         except Exception as e:
             print(f"❌ Ошибка: {e}")
@@ -75,9 +99,20 @@ class AdminConsole:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"admin_export_{timestamp}.xlsx"
         
-        with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-            pd.read_sql("SELECT * FROM users", self.conn).to_excel(writer, sheet_name='Пользователи', index=False)
-            pd.read_sql("SELECT * FROM stock", self.conn).to_excel(writer, sheet_name='Склад', index=False)
+        # write_only: строки пишутся потоком, книга не держится в памяти целиком
+        wb = openpyxl.Workbook(write_only=True)
+        for sheet_name, query in (('Пользователи', "SELECT * FROM users"),
+                                  ('Склад', "SELECT * FROM stock")):
+            ws = wb.create_sheet(sheet_name)
+            cursor = self.conn.execute(query)
+            ws.append([column[0] for column in cursor.description])
+            while True:
+                rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    ws.append(row)
+        wb.save(filename)
         
         print(f"✅ Данные экспортированы в {filename}")
         return filename
@@ -96,11 +131,16 @@ class AdminConsole:
         """Показать статистику"""
         cursor = self.conn.cursor()
         
-        total_users = cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-        total_dealers = cursor.execute("SELECT COUNT(*) FROM users WHERE role = 'Дилер'").fetchone()[0]
-        total_buyers = cursor.execute("SELECT COUNT(*) FROM users WHERE role = 'Покупатель'").fetchone()[0]
-        total_stock = cursor.execute("SELECT COUNT(*) FROM stock").fetchone()[0]
-        total_items = cursor.execute("SELECT SUM(qty_available) FROM stock").fetchone()[0] or 0
+        # Один проход по каждой таблице вместо пяти отдельных запросов
+        total_users, total_dealers, total_buyers = cursor.execute("""
+            SELECT COUNT(*),
+                   COALESCE(SUM(role = 'Дилер'), 0),
+                   COALESCE(SUM(role = 'Покупатель'), 0)
+            FROM users
+        """).fetchone()
+        total_stock, total_items = cursor.execute(
+            "SELECT COUNT(*), COALESCE(SUM(qty_available), 0) FROM stock"
+        ).fetchone()
         
         print("\n📊 СТАТИСТИКА СИСТЕМЫ:")
         print(f"👥 Всего пользователей: {total_users}")
@@ -5,10 +5,11 @@ from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-import pandas as pd
-import aiofiles
-from database import db
+import openpyxl
+from database import AsyncDatabase, INSERT_STOCK
 import os
+import tempfile
+import time
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -20,6 +21,33 @@ BOT_TOKEN = "8294936286:AAGfR-q_GGWIlxS4QlOwhAsJyFtSgFKKK_I"
 # Инициализация бота и диспетчера
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
+db = AsyncDatabase()
+
+# telegram_id -> (users.id, время записи) для уже зарегистрированных пользователей.
+# Пользователей удаляют и из admin_console в другом процессе, поэтому запись живет
+# не дольше UID_CACHE_TTL секунд, а сам кэш не растет больше UID_CACHE_MAX записей
+UID_CACHE_TTL = 60
+UID_CACHE_MAX = 10000
+_uid_cache: dict[int, tuple[int, float]] = {}
+
+def cache_user_id(telegram_id, user_id):
+    """Запоминает users.id пользователя, вытесняя самую старую запись при переполнении"""
+    _uid_cache.pop(telegram_id, None)
+    if len(_uid_cache) >= UID_CACHE_MAX:
+        del _uid_cache[next(iter(_uid_cache))]
+    _uid_cache[telegram_id] = (user_id, time.monotonic())
+
+async def get_user_id(telegram_id):
+    """ID пользователя в базе по telegram_id (None, если не зарегистрирован)"""
+    entry = _uid_cache.get(telegram_id)
+    if entry is not None and time.monotonic() - entry[1] < UID_CACHE_TTL:
+        return entry[0]
+    _uid_cache.pop(telegram_id, None)
+    user = await db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
+    if user:
+        cache_user_id(telegram_id, user[0])
+        return user[0]
+    return None
 
 # Состояния для добавления товара
 class AddStock(StatesGroup):
@@ -39,28 +67,62 @@ class SearchStock(StatesGroup):
     waiting_for_country = State()
     waiting_for_region = State()
 
+# Колонки склада, по которым фильтрует поиск
+SEARCH_COLUMNS = ('tyre_size', 'load_index', 'brand', 'country', 'region')
+
+# Максимальная длина одного сообщения с результатами поиска
+MESSAGE_LIMIT = 4000
+
+# Шаблон одного товара в результатах поиска
+SEARCH_ITEM_TEMPLATE = (
+    "📏 Размер: {}\n"
+    "⚡ Индекс нагрузки: {}\n"
+    "🏷️ Бренд: {}\n"
+    "🌍 Страна: {}\n"
+    "📊 Количество: {}\n"
+    "💰 Цена: {} руб.\n"
+    "📍 Регион: {}\n"
+    "👤 Продавец: {}\n"
+    "📞 Контакт: {}\n"
+    + "─" * 30 + "\n"
+)
+
 # Клавиатура для выбора роли
-def get_role_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Дилер"), KeyboardButton(text="Покупатель")],
-            [KeyboardButton(text="Дилер и Покупатель")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
+ROLE_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Дилер"), KeyboardButton(text="Покупатель")],
+        [KeyboardButton(text="Дилер и Покупатель")]
+    ],
+    resize_keyboard=True
+)
 
 # Клавиатура для главного меню
-def get_main_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="/addstock"), KeyboardButton(text="/mystock")],
-            [KeyboardButton(text="/search"), KeyboardButton(text="/help")],
-            [KeyboardButton(text="❌ Отмена")]
-        ],
-        resize_keyboard=True
+MAIN_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="/addstock"), KeyboardButton(text="/mystock")],
+        [KeyboardButton(text="/search"), KeyboardButton(text="/help")],
+        [KeyboardButton(text="❌ Отмена")]
+    ],
+    resize_keyboard=True
+)
+
+# Команда для отмены операции
+@dp.message(Command("cancel"))
+@dp.message(F.text.casefold() == "отмена")
+async def cancel_handler(message: Message, state: FSMContext):
+    current_state = await state.get_state()
+    if current_state is None:
+        await message.answer(
+            "Нет активных операций для отмены.",
+            reply_markup=MAIN_KB
+        )
+        return
+    
+    await state.clear()
+    await message.answer(
+        "❌ Операция отменена.",
+        reply_markup=MAIN_KB
     )
-    return keyboard
 
 # Команда /start
 @dp.message(Command("start"))
@@ -69,19 +131,17 @@ async def cmd_start(message: Message):
     user_name = message.from_user.full_name
     
     # Проверяем, зарегистрирован ли пользователь
-    user = db.fetchone("SELECT * FROM users WHERE telegram_id = ?", (user_id,))
-    
-    if not user:
+    if await get_user_id(user_id) is None:
         await message.answer(
             f"Добро пожаловать в Tyreterra, {user_name}!\n"
             "Пожалуйста, выберите вашу роль:",
-            reply_markup=get_role_keyboard()
+            reply_markup=ROLE_KB
         )
     else:
         await message.answer(
             f"С возвращением, {user_name}!\n"
             "Используйте команды для работы с системой:",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KB
         )
 
 # Обработка выбора роли
@@ -93,10 +153,11 @@ async def process_role(message: Message):
     
     # Сохраняем пользователя в базу данных
     try:
-        db.execute(
+        new_id = await db.execute(
             "INSERT INTO users (telegram_id, name, role) VALUES (?, ?, ?)",
             (user_id, user_name, role)
         )
+        cache_user_id(user_id, new_id)
         await message.answer(
             f"Отлично! Вы зарегистрированы как {role}.\n\n"
             "Доступные команды:\n"
@@ -104,7 +165,7 @@ async def process_role(message: Message):
             "/mystock - посмотреть мой склад\n"
             "/search - поиск товаров\n"
             "/help - помощь",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KB
         )
     except Exception as e:
         await message.answer("Произошла ошибка при регистрации. Попробуйте снова.")
@@ -116,7 +177,7 @@ async def cmd_addstock(message: Message, state: FSMContext):
         "Давайте добавим новый товар на склад.\n"
         "Введите размер шины (например: 195/65 R15):\n\n"
         "❌ Для отмены введите 'отмена' или нажмите кнопку 'Отмена'",
-        reply_markup=get_main_keyboard()  # Это добавит кнопку отмены
+        reply_markup=MAIN_KB  # Это добавит кнопку отмены
     )
     await state.set_state(AddStock.waiting_for_size)
 
@@ -183,16 +244,12 @@ async def process_region(message: Message, state: FSMContext):
         user_data = await state.get_data()
         
         # Получаем ID пользователя
-        user = db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (message.from_user.id,))
+        user_id = await get_user_id(message.from_user.id)
         
-        if user:
-            user_id = user[0]
-            
+        if user_id is not None:
             # Сохраняем товар в базу данных
-            db.execute(
-                """INSERT INTO stock 
-                (user_id, tyre_size, load_index, brand, country, qty, price, region) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            await db.execute(
+                INSERT_STOCK,
                 (user_id, user_data['tyre_size'], user_data['load_index'], 
                  user_data['brand'], user_data['country'], user_data['qty'], 
                  user_data['price'], message.text)
@@ -207,7 +264,7 @@ async def process_region(message: Message, state: FSMContext):
                 f"📊 Количество: {user_data['qty']}\n"
                 f"💰 Цена: {user_data['price']} руб.\n"
                 f"📍 Регион: {message.text}",
-                reply_markup=get_main_keyboard()
+                reply_markup=MAIN_KB
             )
         else:
             await message.answer("Ошибка: пользователь не найден. Используйте /start для регистрации.")
@@ -220,60 +277,9 @@ async def process_region(message: Message, state: FSMContext):
         await state.clear()
         await message.answer(
             "❌ Произошла ошибка при добавлении товара. Попробуйте снова.",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KB
         )
 
-        # Состояния для добавления товара
-class AddStock(StatesGroup):
-    waiting_for_size = State()
-    waiting_for_load_index = State()
-    waiting_for_brand = State()
-    waiting_for_country = State()
-    waiting_for_qty = State()
-    waiting_for_price = State()
-    waiting_for_region = State()
-
-# Состояния для поиска
-class SearchStock(StatesGroup):
-    waiting_for_size = State()
-    waiting_for_load_index = State()
-    waiting_for_brand = State()
-    waiting_for_country = State()
-    waiting_for_region = State()
-
-# ↓↓↓ ДОБАВЬТЕ ЭТОТ КОД ЗДЕСЬ ↓↓↓
-
-# Команда для отмены операции
-@dp.message(Command("cancel"))
-@dp.message(F.text.casefold() == "отмена")
-async def cancel_handler(message: Message, state: FSMContext):
-    current_state = await state.get_state()
-    if current_state is None:
-        await message.answer(
-            "Нет активных операций для отмены.",
-            reply_markup=get_main_keyboard()
-        )
-        return
-    
-    await state.clear()
-    await message.answer(
-        "❌ Операция отменена.",
-        reply_markup=get_main_keyboard()
-    )
-
-# ↑↑↑ ДОБАВЬТЕ ЭТОТ КОД ЗДЕСЬ ↑↑↑
-
-# Клавиатура для выбора роли
-def get_role_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Дилер"), KeyboardButton(text="Покупатель")],
-            [KeyboardButton(text="Дилер и Покупатель")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
-
 # Команда /search - поиск товаров
 @dp.message(Command("search"))
 async def cmd_search(message: Message, state: FSMContext):
@@ -281,17 +287,14 @@ async def cmd_search(message: Message, state: FSMContext):
         "🔍 Поиск товаров\n"
         "Введите размер шины для поиска (или 'все' для поиска всех товаров):\n\n"
         "❌ Для отмены введите 'отмена' или нажмите кнопку 'Отмена'",
-        reply_markup=get_main_keyboard()  # Это добавит кнопку отмены
+        reply_markup=MAIN_KB  # Это добавит кнопку отмены
     )
     await state.set_state(SearchStock.waiting_for_size)
 
 # Обработка поиска по размеру
 @dp.message(SearchStock.waiting_for_size)
 async def process_search_size(message: Message, state: FSMContext):
-    if message.text.lower() == 'все':
-        await state.update_data(tyre_size='%')
-    else:
-        await state.update_data(tyre_size=f'%{message.text}%')
+    await state.update_data(tyre_size=None if message.text.lower() == 'все' else message.text)
     
     await message.answer("Введите индекс нагрузки для поиска (или 'все' для пропуска):")
     await state.set_state(SearchStock.waiting_for_load_index)
@@ -299,10 +302,7 @@ async def process_search_size(message: Message, state: FSMContext):
 # Обработка поиска по индексу нагрузки
 @dp.message(SearchStock.waiting_for_load_index)
 async def process_search_load_index(message: Message, state: FSMContext):
-    if message.text.lower() == 'все':
-        await state.update_data(load_index='%')
-    else:
-        await state.update_data(load_index=f'%{message.text}%')
+    await state.update_data(load_index=None if message.text.lower() == 'все' else message.text)
     
     await message.answer("Введите бренд для поиска (или 'все' для пропуска):")
     await state.set_state(SearchStock.waiting_for_brand)
@@ -310,10 +310,7 @@ async def process_search_load_index(message: Message, state: FSMContext):
 # Обработка поиска по бренду
 @dp.message(SearchStock.waiting_for_brand)
 async def process_search_brand(message: Message, state: FSMContext):
-    if message.text.lower() == 'все':
-        await state.update_data(brand='%')
-    else:
-        await state.update_data(brand=f'%{message.text}%')
+    await state.update_data(brand=None if message.text.lower() == 'все' else message.text)
     
     await message.answer("Введите страну производства для поиска (или 'все' для пропуска):")
     await state.set_state(SearchStock.waiting_for_country)
@@ -321,10 +318,7 @@ async def process_search_brand(message: Message, state: FSMContext):
 # Обработка поиска по стране и выполнение поиска
 @dp.message(SearchStock.waiting_for_country)
 async def process_search_country(message: Message, state: FSMContext):
-    if message.text.lower() == 'все':
-        await state.update_data(country='%')
-    else:
-        await state.update_data(country=f'%{message.text}%')
+    await state.update_data(country=None if message.text.lower() == 'все' else message.text)
     
     await message.answer("Введите регион для поиска (или 'все' для пропуска):")
     await state.set_state(SearchStock.waiting_for_region)
@@ -333,110 +327,87 @@ async def process_search_country(message: Message, state: FSMContext):
 @dp.message(SearchStock.waiting_for_region)
 async def process_search_region(message: Message, state: FSMContext):
     search_data = await state.get_data()
+    search_data['region'] = None if message.text.lower() == 'все' else message.text
     
-    if message.text.lower() == 'все':
-        region_filter = '%'
-    else:
-        region_filter = f'%{message.text}%'
+    # Фильтры со значением 'все' не попадают в запрос вовсе
+    conditions = []
+    params = []
+    for column in SEARCH_COLUMNS:
+        value = search_data.get(column)
+        if value is not None:
+            conditions.append(f"s.{column} LIKE ?")
+            params.append(f'%{value}%')
+    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
     
     # Выполняем поиск
-    stock_items = db.fetchall(
-        """SELECT s.*, u.name, u.contact 
+    stock_items = await db.fetchall(
+        f"""SELECT s.tyre_size, s.load_index, s.brand, s.country, s.qty, s.price,
+               s.region, u.name, COALESCE(NULLIF(u.contact, ''), 'Не указан')
         FROM stock s 
         JOIN users u ON s.user_id = u.id 
-        WHERE s.tyre_size LIKE ? 
-        AND s.load_index LIKE ? 
-        AND s.brand LIKE ? 
-        AND s.country LIKE ? 
-        AND s.region LIKE ? 
+        {where_clause}
         ORDER BY s.date DESC""",
-        (search_data['tyre_size'], search_data['load_index'], 
-         search_data['brand'], search_data['country'], region_filter)
+        params
     )
     
     if not stock_items:
         await message.answer(
             "❌ По вашему запросу ничего не найдено.",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KB
         )
     else:
-        response = f"🔍 Найдено товаров: {len(stock_items)}\n\n"
+        buffer = [f"🔍 Найдено товаров: {len(stock_items)}\n\n"]
+        buffer_len = len(buffer[0])
         
+        # Отправляем сообщения по мере набора, не разрывая карточки товаров
         for item in stock_items:
-            response += (
-                f"📏 Размер: {item[2]}\n"
-                f"⚡ Индекс нагрузки: {item[3]}\n"
-                f"🏷️ Бренд: {item[4]}\n"
-                f"🌍 Страна: {item[5]}\n"
-                f"📊 Количество: {item[6]}\n"
-                f"💰 Цена: {item[7]} руб.\n"
-                f"📍 Регион: {item[8]}\n"
-                f"👤 Продавец: {item[10]}\n"
-                f"📞 Контакт: {item[11] if item[11] else 'Не указан'}\n"
-                "─" * 30 + "\n"
-            )
-        
-        # Разбиваем сообщение если оно слишком длинное
-        if len(response) > 4000:
-            parts = [response[i:i+4000] for i in range(0, len(response), 4000)]
-            for part in parts:
-                await message.answer(part)
-        else:
-            await message.answer(response)
+            text = SEARCH_ITEM_TEMPLATE.format(*item)
+            if buffer_len + len(text) > MESSAGE_LIMIT:
+                await message.answer("".join(buffer))
+                buffer, buffer_len = [], 0
+            buffer.append(text)
+            buffer_len += len(text)
+        await message.answer("".join(buffer))
     
     await state.clear()
-    await message.answer("Поиск завершен.", reply_markup=get_main_keyboard())
-
-# Состояния для добавления товара
-class AddStock(StatesGroup):
-    waiting_for_size = State()
-    waiting_for_load_index = State()
-    waiting_for_brand = State()
-    waiting_for_country = State()
-    waiting_for_qty = State()
-    waiting_for_price = State()
-    waiting_for_region = State()
+    await message.answer("Поиск завершен.", reply_markup=MAIN_KB)
 
-# Состояния для поиска
-class SearchStock(StatesGroup):
-    waiting_for_size = State()
-    waiting_for_load_index = State()
-    waiting_for_brand = State()
-    waiting_for_country = State()
-    waiting_for_region = State()
+# Колонки, обязательные в загружаемом Excel файле
+UPLOAD_COLUMNS = ('tyre_size', 'load_index', 'brand', 'country', 'qty', 'price', 'region')
 
-# ↓↓↓ ДОБАВЬТЕ ЭТОТ КОД ЗДЕСЬ ↓↓↓
-
-# Команда для отмены операции
-@dp.message(Command("cancel"))
-@dp.message(F.text.casefold() == "отмена")
-async def cancel_handler(message: Message, state: FSMContext):
-    current_state = await state.get_state()
-    if current_state is None:
-        await message.answer(
-            "Нет активных операций для отмены.",
-            reply_markup=get_main_keyboard()
-        )
-        return
-    
-    await state.clear()
-    await message.answer(
-        "❌ Операция отменена.",
-        reply_markup=get_main_keyboard()
-    )
-
-# ↑↑↑ ДОБАВЬТЕ ЭТОТ КОД ЗДЕСЬ ↑↑↑
-
-# Клавиатура для выбора роли
-def get_role_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Дилер"), KeyboardButton(text="Покупатель")],
-            [KeyboardButton(text="Дилер и Покупатель")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
+def read_stock_rows(path, user_id):
+    """Прочитать товары из Excel файла: (недостающие колонки, строки для вставки)"""
+    # Читаем Excel файл построчно, без загрузки всего листа в память
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet_rows = wb.active.iter_rows(values_only=True)
+        header = next(sheet_rows, ())
+        positions = {name: i for i, name in enumerate(header)}
+        
+        # Проверяем необходимые колонки
+        missing_columns = [col for col in UPLOAD_COLUMNS if col not in positions]
+        if missing_columns:
+            return missing_columns, []
+        
+        indices = [positions[col] for col in UPLOAD_COLUMNS]
+        rows = []
+        for row in sheet_rows:
+            if not any(row):
+                continue
+            try:
+                tyre_size, load_index, brand, country, qty, price, region = (
+                    row[i] for i in indices
+                )
+                rows.append(
+                    (user_id, tyre_size, load_index, brand,
+                     country, int(qty), float(price), region)
+                )
+            except Exception as e:
+                logger.error(f"Ошибка при добавлении строки: {e}")
+                continue
+        return [], rows
+    finally:
+        wb.close()
 
 # Обработка загрузки Excel файлов
 @dp.message(F.document)
@@ -444,65 +415,48 @@ async def handle_excel_file(message: Message):
     if message.document.mime_type in ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 
                                     'application/vnd.ms-excel']:
         
+        # Получаем ID пользователя
+        user_id = await get_user_id(message.from_user.id)
+        if user_id is None:
+            await message.answer("❌ Сначала зарегистрируйтесь с помощью /start")
+            return
+        
         # Получаем информацию о файле
         file_id = message.document.file_id
         file = await bot.get_file(file_id)
         file_path = file.file_path
         
         # Создаем папку для загрузок если ее нет
-        if not os.path.exists('uploads'):
-            os.makedirs('uploads')
+        os.makedirs('uploads', exist_ok=True)
         
-        # Скачиваем файл
-        download_path = f"uploads/{message.document.file_name}"
-        await bot.download_file(file_path, download_path)
+        # Уникальное имя вместо имени файла от пользователя
+        with tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False, dir='uploads') as tmp:
+            download_path = tmp.name
         
         try:
-            # Читаем Excel файл
-            df = pd.read_excel(download_path)
+            # Скачиваем файл: при пути назначения aiogram пишет его на диск по частям
+            await bot.download_file(file_path, destination=download_path, chunk_size=65536)
             
-            # Проверяем необходимые колонки
-            required_columns = ['tyre_size', 'load_index', 'brand', 'country', 'qty', 'price', 'region']
-            missing_columns = [col for col in required_columns if col not in df.columns]
+            # Разбор файла идет в отдельном потоке, чтобы не блокировать других пользователей
+            missing_columns, rows = await asyncio.to_thread(read_stock_rows, download_path, user_id)
             
             if missing_columns:
                 await message.answer(f"❌ В файле отсутствуют колонки: {', '.join(missing_columns)}")
                 return
-            
-            # Получаем ID пользователя
-            user = db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (message.from_user.id,))
-            if not user:
-                await message.answer("❌ Сначала зарегистрируйтесь с помощью /start")
-                return
-            
-            user_id = user[0]
+
+            # Добавляем строки в базу одной транзакцией
             added_count = 0
-            
-            # Добавляем товары в базу данных
-            for _, row in df.iterrows():
-                try:
-                    db.execute(
-                        """INSERT INTO stock 
-                        (user_id, tyre_size, load_index, brand, country, qty, price, region) 
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-                        (user_id, row['tyre_size'], row['load_index'], row['brand'], 
-                         row['country'], int(row['qty']), float(row['price']), row['region'])
-                    )
-                    added_count += 1
-                except Exception as e:
-                    logger.error(f"Ошибка при добавлении строки: {e}")
-                    continue
-            
+            if rows:
+                await db.executemany(INSERT_STOCK, rows)
+                added_count = len(rows)
+
             await message.answer(f"✅ Успешно добавлено {added_count} товаров из Excel файла!")
             
         except Exception as e:
             await message.answer(f"❌ Ошибка при обработке Excel файла: {str(e)}")
-        
-        # Удаляем временный файл
-        try:
-            os.remove(download_path)
-        except:
-            pass
+        finally:
+            # Удаляем временный файл при любом исходе
+            os.unlink(download_path)
     else:
         await message.answer("❌ Пожалуйста, отправьте файл в формате Excel (.xlsx)")
 
@@ -529,13 +483,17 @@ async def cmd_help(message: Message):
 async def unknown_message(message: Message):
     await message.answer(
         "Неизвестная команда. Используйте /help для списка доступных команд.",
-        reply_markup=get_main_keyboard()
+        reply_markup=MAIN_KB
     )
 
 # Запуск бота
 async def main():
     logger.info("Бот Tyreterra запускается...")
-    await dp.start_polling(bot)
+    await db.init()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
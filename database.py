@@ -1,76 +1,153 @@
 import sqlite3
 import asyncio
+import atexit
+import threading
 from datetime import datetime
 
+import aiosqlite
+
+# WAL и ослабленный synchronous: коммит без fsync на каждую вставку
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA mmap_size=268435456",
+]
+
+SCHEMA = [
+    # Таблица пользователей
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER UNIQUE,
+        name TEXT,
+        contact TEXT,
+        role TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # Таблица склада
+    '''
+    CREATE TABLE IF NOT EXISTS stock (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        tyre_size TEXT,
+        load_index TEXT,
+        brand TEXT,
+        country TEXT,
+        qty INTEGER,
+        price REAL,
+        region TEXT,
+        date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''',
+    # Индекс для выборок по пользователю. Поиск идет через LIKE '%...%', индекс ему
+    # не помогает, поэтому индекс (tyre_size, brand) убираем и из уже созданных баз
+    "CREATE INDEX IF NOT EXISTS idx_stock_user ON stock(user_id)",
+    "DROP INDEX IF EXISTS idx_stock_size_brand",
+]
+
+# Один текст запроса для всех вставок товара: sqlite3 компилирует его один раз
+# и дальше берет из кэша подготовленных выражений соединения
+INSERT_STOCK = (
+    "INSERT INTO stock (user_id, tyre_size, load_index, brand, country, qty, price, region) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
 class Database:
     def __init__(self, db_path='tyreterra.db'):
         self.db_path = db_path
+        # Одно соединение на весь процесс вместо connect/close на каждый запрос
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        atexit.register(self._conn.close)
         self.init_db()
     
     def init_db(self):
         """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER UNIQUE,
-                name TEXT,
-                contact TEXT,
-                role TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Таблица склада
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS stock (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                tyre_size TEXT,
-                load_index TEXT,
-                brand TEXT,
-                country TEXT,
-                qty INTEGER,
-                price REAL,
-                region TEXT,
-                date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        cursor = self._conn.cursor()
+        for statement in PRAGMAS + SCHEMA:
+            cursor.execute(statement)
     
     def execute(self, query, params=()):
         """Выполнить запрос"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        conn.commit()
-        result = cursor.lastrowid
-        conn.close()
-        return result
-    
+        with self._lock:
+            cursor = self._conn.execute(query, params)
+            return cursor.lastrowid
+
+    def executemany(self, query, seq_of_params):
+        """Выполнить запрос для набора параметров в одной транзакции"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                cursor = self._conn.executemany(query, seq_of_params)
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return cursor.rowcount
+
     def fetchone(self, query, params=()):
         """Получить одну запись"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        result = cursor.fetchone()
-        conn.close()
-        return result
+        with self._lock:
+            return self._conn.execute(query, params).fetchone()
     
     def fetchall(self, query, params=()):
         """Получить все записи"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        result = cursor.fetchall()
-        conn.close()
-        return result
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+class AsyncDatabase:
+    """Асинхронный доступ к базе для бота: запросы не блокируют event loop"""
+
+    def __init__(self, db_path='tyreterra.db'):
+        self.db_path = db_path
+        self._conn = None
+        self._lock = asyncio.Lock()
+
+    async def init(self):
+        """Открыть соединение, применить PRAGMA и создать таблицы"""
+        self._conn = await aiosqlite.connect(self.db_path, isolation_level=None)
+        for statement in PRAGMAS + SCHEMA:
+            await self._conn.execute(statement)
+
+    async def close(self):
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def execute(self, query, params=()):
+        """Выполнить запрос"""
+        async with self._lock:
+            cursor = await self._conn.execute(query, params)
+            return cursor.lastrowid
+
+    async def executemany(self, query, seq_of_params):
+        """Выполнить запрос для набора параметров в одной транзакции"""
+        async with self._lock:
+            await self._conn.execute("BEGIN")
+            try:
+                cursor = await self._conn.executemany(query, seq_of_params)
+            except Exception:
+                await self._conn.execute("ROLLBACK")
+                raise
+            await self._conn.execute("COMMIT")
+            return cursor.rowcount
+
+    async def fetchone(self, query, params=()):
+        """Получить одну запись"""
+        async with self._lock:
+            cursor = await self._conn.execute(query, params)
+            return await cursor.fetchone()
+
+    async def fetchall(self, query, params=()):
+        """Получить все записи"""
+        async with self._lock:
+            cursor = await self._conn.execute(query, params)
+            return await cursor.fetchall()
 
 # Создаем экземпляр базы данных
 db = Database()
\ No newline at end of file
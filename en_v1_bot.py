@@ -1,13 +1,20 @@
 import asyncio
+import functools
+import inspect
 import logging
+import queue
 import sqlite3
 import os
 import time
 import re
-import shutil
+import heapq
+import uuid
 import aiosqlite
-from datetime import datetime
-from collections import deque
+import xlsxwriter
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict
+from itertools import islice
+from contextlib import asynccontextmanager
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
@@ -15,8 +22,8 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 
-import pandas as pd
 import aiofiles
 
 # =============================================================================
@@ -24,20 +31,28 @@ import aiofiles
 # =============================================================================
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8294936286:AAGfR-q_GGWIlxS4QlOwhAsJyFtSgFKKK_I")
-ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "7975448643").split(',')))
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "7975448643").split(',') if x)
 DB_PATH = os.getenv("DB_PATH", "tyreterra.db")
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", str(os.cpu_count() or 4)))
 MAX_STOCK_ITEMS = int(os.getenv("MAX_STOCK_ITEMS", "10000"))
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", "52428800"))  # 50MB
 
-# Logging setup
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('tyreterra.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Logging setup: handlers only enqueue records, a listener thread does the I/O
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [
+    logging.FileHandler('tyreterra.log', encoding='utf-8'),
+    logging.StreamHandler()
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, *log_handlers)
+log_listener.start()
+
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(QueueHandler(log_queue))
 logger = logging.getLogger(__name__)
 
 # =============================================================================
@@ -45,74 +60,250 @@ logger = logging.getLogger(__name__)
 # =============================================================================
 
 class Cache:
-    def __init__(self, timeout=300):
-        self.cache = {}
+    """TTL cache with LRU eviction and a background sweeper for expired keys"""
+    def __init__(self, timeout=300, max_size=1000, sweep_interval=60):
+        self.cache = OrderedDict()  # key -> (data, expiry)
+        self._heap = []  # (expiry, key), may hold stale entries for overwritten keys
         self.timeout = timeout
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
     
     def get(self, key):
         if key in self.cache:
-            data, timestamp = self.cache[key]
-            if time.time() - timestamp < self.timeout:
+            data, expiry = self.cache[key]
+            if time.time() < expiry:
+                self.cache.move_to_end(key)
                 return data
             else:
                 del self.cache[key]
         return None
     
     def set(self, key, data):
-        self.cache[key] = (data, time.time())
+        expiry = time.time() + self.timeout
+        self.cache[key] = (data, expiry)
+        self.cache.move_to_end(key)
+        heapq.heappush(self._heap, (expiry, key))
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+    
+    def delete(self, key):
+        self.cache.pop(key, None)
     
     def clear(self):
         self.cache.clear()
+        self._heap.clear()
+    
+    def sweep(self):
+        """Drop expired entries, touching only the ones that expired"""
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            expiry, key = heapq.heappop(self._heap)
+            entry = self.cache.get(key)
+            if entry is not None and entry[1] == expiry:
+                del self.cache[key]
+    
+    async def run_sweeper(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
 
 cache = Cache()
 
 class RateLimiter:
+    """Token bucket per user: max_requests tokens, refilled evenly over window seconds"""
     def __init__(self, max_requests=10, window=60):
-        self.requests = {}
+        self.buckets = {}  # user_id -> (tokens, last update)
         self.max_requests = max_requests
         self.window = window
+        self.rate = max_requests / window
     
-    def is_limited(self, user_id):
-        now = time.time()
-        if user_id not in self.requests:
-            self.requests[user_id] = []
-        
-        self.requests[user_id] = [req_time for req_time in self.requests[user_id] if now - req_time < self.window]
+    def is_limited(self, user_id, weight=1):
+        # Heavy requests take several tokens in the same single check, nothing to roll back
+        now = time.monotonic()
+        tokens, last = self.buckets.get(user_id, (self.max_requests, now))
+        tokens = min(self.max_requests, tokens + (now - last) * self.rate)
         
-        if len(self.requests[user_id]) >= self.max_requests:
+        if tokens < weight:
+            self.buckets[user_id] = (tokens, now)
             return True
         
-        self.requests[user_id].append(now)
+        self.buckets[user_id] = (tokens - weight, now)
         return False
+    
+    def prune(self):
+        """Forget users idle long enough for their bucket to be full again"""
+        cutoff = time.monotonic() - self.window
+        for user_id in [uid for uid, (_, last) in self.buckets.items() if last < cutoff]:
+            del self.buckets[user_id]
+    
+    async def run_pruner(self):
+        while True:
+            await asyncio.sleep(self.window)
+            self.prune()
 
 rate_limiter = RateLimiter()
 
+# Cost of requests that build an xlsx file, in tokens of the same bucket
+HEAVY_REQUEST_WEIGHT = 5
+
+TEMP_FILE_TTL = 3600
+TEMP_CLEANUP_INTERVAL = 600
+TEMP_DIR_MAX_BYTES = int(os.getenv("TEMP_DIR_MAX_MB", "500")) * 1024 * 1024
+
 def cleanup_temp_files():
-    """Clean up files older than 1 hour"""
+    """Clean up files older than 1 hour and keep temp_files under the size cap"""
     try:
-        current_time = time.time()
-        if not os.path.exists('temp_files'):
-            return
-            
-        for filename in os.listdir('temp_files'):
-            filepath = os.path.join('temp_files', filename)
-            if os.path.isfile(filepath):
-                if current_time - os.path.getmtime(filepath) > 3600:
-                    os.remove(filepath)
+        # scandir caches the entry type, so each file costs a single stat
+        cutoff = time.time() - TEMP_FILE_TTL
+        files = []
+        with os.scandir('temp_files') as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat()
+                if st.st_mtime < cutoff:
+                    os.remove(entry.path)
+                elif not entry.name.endswith('.part'):
+                    files.append((st.st_mtime, st.st_size, entry.path))
+        
+        # Over the cap: drop the least recently written files first
+        total = sum(size for _, size, _ in files)
+        if total > TEMP_DIR_MAX_BYTES:
+            for _, size, path in sorted(files):
+                os.remove(path)
+                total -= size
+                if total <= TEMP_DIR_MAX_BYTES:
+                    break
+    except FileNotFoundError:
+        # main() creates the directory; nothing to clean before that
+        return
     except Exception as e:
         logger.error(f"Error cleaning temp files: {e}")
 
+_stamp = [0, ""]
+
+def now_stamp():
+    """Local time as YYYYmmdd_HHMMSS, formatted at most once per second"""
+    now = int(time.time())
+    if now != _stamp[0]:
+        _stamp[:] = [now, time.strftime("%Y%m%d_%H%M%S", time.localtime(now))]
+    return _stamp[1]
+
+def temp_path(prefix, stamp, ext='xlsx'):
+    """Path in temp_files; the random suffix keeps exports made in the same second apart"""
+    return f"temp_files/{prefix}_{stamp}_{os.urandom(3).hex()}.{ext}"
+
+async def run_temp_cleanup():
+    while True:
+        await asyncio.to_thread(cleanup_temp_files)
+        await asyncio.sleep(TEMP_CLEANUP_INTERVAL)
+
 # =============================================================================
 # DATABASE (ASYNC)
 # =============================================================================
 
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA foreign_keys=ON",
+)
+
+# Hot queries kept as constants: sqlite3 caches compiled statements by SQL text
+SQL_GET_USER_ID_ROLE = "SELECT id, role FROM users WHERE telegram_id = ?"
+SQL_COUNT_USER_STOCK = "SELECT cnt FROM stock_counts WHERE user_id = ?"
+SQL_STOCK_VERSION = """
+    SELECT (SELECT cnt FROM stock_counts WHERE user_id = ?1),
+           (SELECT version FROM stock_versions WHERE user_id = ?1)
+"""
+SQL_USER_STATS = """
+    SELECT COUNT(*) AS total,
+           SUM(role = 'Dealer') AS dealers,
+           SUM(role = 'Buyer') AS buyers,
+           SUM(created_at > datetime('now', '-7 days')) AS recent
+    FROM users
+"""
+
+# owners comes from the trigger-maintained counters instead of a GROUP BY over stock
+SQL_STOCK_STATS = """
+    SELECT COUNT(*) AS total,
+           SUM(retail_price * qty_available) AS value,
+           SUM(date > datetime('now', '-7 days')) AS recent,
+           (SELECT COUNT(*) FROM stock_counts WHERE cnt > 0) AS owners
+    FROM stock
+"""
+
+# Admin SQL starting like this goes to a read-only connection and comes back as xlsx;
+# a WITH that turns out to write fails there instead of modifying data
+ADMIN_READ_SQL_RE = re.compile(r'(select|with|explain)\b', re.IGNORECASE)
+
+# Admin reads: fixed statement texts, so every call is a prepared-statement cache hit
+SQL_ADMIN_USERS = "SELECT * FROM users ORDER BY created_at DESC"
+SQL_ADMIN_ALL_STOCK = """
+    SELECT s.*, u.name, u.company_name, u.phone, u.email 
+    FROM stock s 
+    JOIN users u ON s.user_id = u.id 
+    ORDER BY s.date DESC
+"""
+SQL_EXPORT_USERS = "SELECT * FROM users"
+SQL_EXPORT_STOCK = "SELECT * FROM stock"
+
+SQL_DELETE_STOCK_ITEM = "DELETE FROM stock WHERE user_id = ? AND sku = ? RETURNING id"
+
+SQL_INSERT_STOCK = (
+    "INSERT INTO stock (user_id, sku, tyre_size, tyre_pattern, brand, country, "
+    "qty_available, retail_price, wholesale_price, warehouse_location) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+EXPORT_BATCH_SIZE = 50_000
+
 class AsyncDatabase:
-    def __init__(self, db_path=DB_PATH):
+    def __init__(self, db_path=DB_PATH, pool_size=DB_READ_POOL_SIZE):
         self.db_path = db_path
+        self.pool_size = pool_size
+        self._conn = None
+        self._lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+    
+    async def _open(self, read_only=False):
+        if read_only:
+            conn = await aiosqlite.connect(f"file:{self.db_path}?mode=ro", uri=True,
+                                           timeout=30.0, cached_statements=256)
+        else:
+            conn = await aiosqlite.connect(self.db_path, timeout=30.0, cached_statements=256)
+        conn.row_factory = aiosqlite.Row
+        for pragma in DB_PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+    
+    async def connect(self):
+        """Open the writer connection and the pool of read-only connections"""
+        self._conn = await self._open()
+        for _ in range(self.pool_size):
+            self._readers.put_nowait(await self._open(read_only=True))
+    
+    @asynccontextmanager
+    async def reader(self):
+        """Borrow a read-only connection from the pool"""
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+    
+    async def close(self):
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+        while not self._readers.empty():
+            await self._readers.get_nowait().close()
     
     async def init_db(self):
         """Initialize database"""
-        async with aiosqlite.connect(self.db_path, timeout=30.0) as conn:
+        async with self._lock:
+            conn = self._conn
             await conn.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -148,40 +339,187 @@ class AsyncDatabase:
             await conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_sku ON stock(sku)')
             await conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_brand ON stock(brand)')
             await conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_user ON stock(user_id)')
+            # (user_id, sku) serves /deleteitem lookups
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_user_sku ON stock(user_id, sku)')
             await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_telegram ON users(telegram_id)')
             await conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_size ON stock(tyre_size)')
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_warehouse ON stock(warehouse_location)')
+            # /mystock reads one user's items newest first straight off this index, no sort step
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_user_date ON stock(user_id, date DESC)')
+            
+            # Per-user item counts kept up to date by triggers, so quota checks don't scan stock
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS stock_counts (
+                    user_id INTEGER PRIMARY KEY,
+                    cnt INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            await conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS stock_ai AFTER INSERT ON stock BEGIN
+                    INSERT INTO stock_counts (user_id, cnt) VALUES (NEW.user_id, 1)
+                    ON CONFLICT(user_id) DO UPDATE SET cnt = cnt + 1;
+                END
+            ''')
+            await conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS stock_ad AFTER DELETE ON stock BEGIN
+                    UPDATE stock_counts SET cnt = cnt - 1 WHERE user_id = OLD.user_id;
+                END
+            ''')
+            # An item moved to another dealer (admin SQL) leaves one count and joins the other
+            await conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS stock_au_user AFTER UPDATE OF user_id ON stock
+                WHEN NEW.user_id IS NOT OLD.user_id BEGIN
+                    UPDATE stock_counts SET cnt = cnt - 1 WHERE user_id = OLD.user_id;
+                    INSERT INTO stock_counts (user_id, cnt) VALUES (NEW.user_id, 1)
+                    ON CONFLICT(user_id) DO UPDATE SET cnt = cnt + 1;
+                END
+            ''')
+            # Backfill users whose stock predates the counter table
+            await conn.execute('''
+                INSERT OR IGNORE INTO stock_counts (user_id, cnt)
+                SELECT user_id, COUNT(*) FROM stock GROUP BY user_id
+            ''')
+            
+            # Per-user change counter for the /mystock file cache: unlike COUNT/MAX(id)
+            # it also moves on in-place UPDATEs (admin SQL, console edits)
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS stock_versions (
+                    user_id INTEGER PRIMARY KEY,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            await conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS stock_ver_ai AFTER INSERT ON stock BEGIN
+                    INSERT INTO stock_versions (user_id, version) VALUES (NEW.user_id, 1)
+                    ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+                END
+            ''')
+            await conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS stock_ver_ad AFTER DELETE ON stock BEGIN
+                    INSERT INTO stock_versions (user_id, version) VALUES (OLD.user_id, 1)
+                    ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+                END
+            ''')
+            await conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS stock_ver_au AFTER UPDATE ON stock BEGIN
+                    INSERT INTO stock_versions (user_id, version) VALUES (OLD.user_id, 1)
+                    ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+                    -- An item moved to another dealer changes that dealer's file too
+                    INSERT INTO stock_versions (user_id, version)
+                    SELECT NEW.user_id, 1 WHERE NEW.user_id IS NOT OLD.user_id
+                    ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+                END
+            ''')
+            
+            # Full-text index over the word-searched columns (SEARCH_FTS_COLUMNS), kept in sync by triggers
+            cursor = await conn.execute("SELECT name FROM pragma_table_info('stock_fts')")
+            fts_columns = tuple(row[0] for row in await cursor.fetchall())
+            if fts_columns and fts_columns != SEARCH_FTS_COLUMNS:
+                # Older layout indexed more columns; drop it and rebuild below
+                for trigger in ('stock_fts_ai', 'stock_fts_ad', 'stock_fts_au'):
+                    await conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+                await conn.execute('DROP TABLE stock_fts')
+                fts_columns = ()
+            fts_exists = bool(fts_columns)
+            await conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS stock_fts USING fts5(
+                    brand, warehouse_location,
+                    content='stock', content_rowid='id'
+                )
+            ''')
+            await conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS stock_fts_ai AFTER INSERT ON stock BEGIN
+                    INSERT INTO stock_fts (rowid, brand, warehouse_location)
+                    VALUES (NEW.id, NEW.brand, NEW.warehouse_location);
+                END
+            ''')
+            await conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS stock_fts_ad AFTER DELETE ON stock BEGIN
+                    INSERT INTO stock_fts (stock_fts, rowid, brand, warehouse_location)
+                    VALUES ('delete', OLD.id, OLD.brand, OLD.warehouse_location);
+                END
+            ''')
+            await conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS stock_fts_au AFTER UPDATE OF brand, warehouse_location ON stock BEGIN
+                    INSERT INTO stock_fts (stock_fts, rowid, brand, warehouse_location)
+                    VALUES ('delete', OLD.id, OLD.brand, OLD.warehouse_location);
+                    INSERT INTO stock_fts (rowid, brand, warehouse_location)
+                    VALUES (NEW.id, NEW.brand, NEW.warehouse_location);
+                END
+            ''')
+            # Index stock that existed before the FTS table was added
+            if not fts_exists:
+                await conn.execute("INSERT INTO stock_fts (stock_fts) VALUES ('rebuild')")
             
             await conn.commit()
+            
+            # Refresh planner statistics so the indexes above are chosen
+            await conn.execute('ANALYZE')
     
     async def execute(self, query, params=()):
-        async with aiosqlite.connect(self.db_path, timeout=30.0) as conn:
-            cursor = await conn.execute(query, params)
-            await conn.commit()
+        async with self._lock:
+            cursor = await self._conn.execute(query, params)
+            await self._conn.commit()
             return cursor.lastrowid
     
+    async def execute_returning(self, query, params=()):
+        """Run a write with a RETURNING clause and return the produced rows"""
+        async with self._lock:
+            cursor = await self._conn.execute(query, params)
+            # Rows must be read before commit, the statement finishes only when drained
+            rows = await cursor.fetchall()
+            await self._conn.commit()
+            return rows
+    
+    async def executemany(self, query, seq_of_params, chunk_size=1000):
+        """Run a query for many parameter sets in a single transaction"""
+        rows = iter(seq_of_params)
+        async with self._lock:
+            # IMMEDIATE takes the write lock up front instead of upgrading mid-batch
+            await self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                while chunk := list(islice(rows, chunk_size)):
+                    await self._conn.executemany(query, chunk)
+            except Exception:
+                await self._conn.rollback()
+                raise
+            await self._conn.commit()
+    
     async def fetchone(self, query, params=()):
-        async with aiosqlite.connect(self.db_path, timeout=30.0) as conn:
-            cursor = await conn.execute(query, params)
-            return await cursor.fetchone()
+        # Closing the cursor resets the statement, so a half-read result doesn't keep
+        # a read snapshot open on the pooled connection and hold back WAL checkpoints
+        async with self.reader() as conn:
+            async with conn.execute(query, params) as cursor:
+                return await cursor.fetchone()
     
     async def fetchall(self, query, params=()):
-        async with aiosqlite.connect(self.db_path, timeout=30.0) as conn:
-            cursor = await conn.execute(query, params)
-            return await cursor.fetchall()
+        async with self.reader() as conn:
+            async with conn.execute(query, params) as cursor:
+                return await cursor.fetchall()
+    
+    async def backup(self, path):
+        """Copies a consistent snapshot of the database to path via the SQLite backup API"""
+        async with aiosqlite.connect(path) as target:
+            async with self.reader() as conn:
+                await conn.backup(target)
+    
+    async def fetch_batches(self, query, params=(), batch_size=EXPORT_BATCH_SIZE):
+        """Yields the result in batches, so at most one batch is held in memory"""
+        async with self.reader() as conn:
+            async with conn.execute(query, params) as cursor:
+                while rows := await cursor.fetchmany(batch_size):
+                    yield rows
+    
+    async def add_stock_items(self, rows):
+        """Bulk insert of stock rows in SQL_INSERT_STOCK column order, one transaction"""
+        await self.executemany(SQL_INSERT_STOCK, rows)
     
     async def get_user_stock_count(self, user_id):
         result = await self.fetchone(
-            "SELECT COUNT(*) FROM stock WHERE user_id = ?", 
+            SQL_COUNT_USER_STOCK,
             (user_id,)
         )
         return result[0] if result else 0
-    
-    async def get_user_role(self, telegram_id):
-        result = await self.fetchone(
-            "SELECT role FROM users WHERE telegram_id = ?", 
-            (telegram_id,)
-        )
-        return result[0] if result else None
 
 db = AsyncDatabase()
 
@@ -189,9 +527,24 @@ db = AsyncDatabase()
 # BOT INITIALIZATION
 # =============================================================================
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode='HTML'))
+# One aiohttp session with a keep-alive connector shared by all API calls
+session = AiohttpSession()
+bot = Bot(
+    token=BOT_TOKEN,
+    session=session,
+    default=DefaultBotProperties(parse_mode='HTML', link_preview_is_disabled=True)
+)
 dp = Dispatcher()
 
+RATE_LIMIT_MSG = "⚠️ Too many requests. Please wait a bit."
+
+# Fixed AddStock prompts, built once at import
+PROMPT_SIZE = "Enter tyre size (e.g.: 195/65 R15):\n\n❌ To cancel enter /cancel"
+PROMPT_PATTERN = "Enter tyre model (tyre pattern):\n\n❌ To cancel enter /cancel"
+PROMPT_BRAND = "Enter tyre brand:\n\n❌ To cancel enter /cancel"
+PROMPT_COUNTRY = "Enter country of origin:\n\n❌ To cancel enter /cancel"
+PROMPT_WAREHOUSE = "Enter warehouse location:\n\n❌ To cancel enter /cancel"
+
 # =============================================================================
 # FSM STATES
 # =============================================================================
@@ -209,9 +562,7 @@ class AddStock(StatesGroup):
     waiting_for_pattern = State()
     waiting_for_brand = State()
     waiting_for_country = State()
-    waiting_for_qty = State()
-    waiting_for_retail_price = State()
-    waiting_for_wholesale_price = State()
+    waiting_for_qty_prices = State()
     waiting_for_warehouse = State()
 
 class SearchStock(StatesGroup):
@@ -241,124 +592,313 @@ class AdminPanel(StatesGroup):
 def is_admin(telegram_id):
     return telegram_id in ADMIN_IDS
 
-async def check_rate_limit(user_id: int) -> bool:
-    if rate_limiter.is_limited(user_id):
-        return True
-    return False
+def check_rate_limit(user_id: int, weight: int = 1) -> bool:
+    # Admins are never throttled
+    return not is_admin(user_id) and rate_limiter.is_limited(user_id, weight)
+
+def rate_limited(handler=None, *, weight=1):
+    """Handler decorator: answers RATE_LIMIT_MSG instead of running a throttled request.
+    weight is a number or a function of the message, for handlers whose cost depends on the input"""
+    if handler is None:
+        return functools.partial(rate_limited, weight=weight)
+    
+    @functools.wraps(handler)
+    async def wrapper(message: Message, *args, **kwargs):
+        # /cancel always gets through, a throttled user must still be able to leave a dialog
+        cost = weight(message) if callable(weight) else weight
+        if message.text != '/cancel' and check_rate_limit(message.from_user.id, cost):
+            await message.answer(RATE_LIMIT_MSG)
+            return
+        return await handler(message, *args, **kwargs)
+    
+    # aiogram picks the kwargs to pass from the signature, so expose the handler's own
+    wrapper.__signature__ = inspect.signature(handler)
+    return wrapper
+
+def admin_required(handler):
+    """Handler decorator: denies access to anyone outside ADMIN_IDS"""
+    @functools.wraps(handler)
+    async def wrapper(message: Message, *args, **kwargs):
+        if not is_admin(message.from_user.id):
+            await message.answer("❌ Access denied. Admin only.")
+            return
+        return await handler(message, *args, **kwargs)
+    
+    wrapper.__signature__ = inspect.signature(handler)
+    return wrapper
+
+async def get_user(telegram_id):
+    """Returns (id, role) of a registered user, cached for repeated FSM steps"""
+    key = f"user:{telegram_id}"
+    user = cache.get(key)
+    if user is None:
+        row = await db.fetchone(SQL_GET_USER_ID_ROLE, (telegram_id,))
+        # Unregistered users are cached as () until registration drops the key
+        user = (row[0], row[1]) if row else ()
+        cache.set(key, user)
+    return user or None
 
 async def get_user_role(telegram_id):
-    return await db.get_user_role(telegram_id)
+    """Role of a registered user, served from the same cached entry as get_user"""
+    user = await get_user(telegram_id)
+    return user[1] if user else None
+
+EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+PHONE_STRIP = str.maketrans('', '', ' -()')
 
 def validate_email(email):
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    # Cheap rejection before running the regex
+    if '@' not in email or '.' not in email.rsplit('@', 1)[-1]:
+        return False
+    return EMAIL_RE.match(email) is not None
 
 def validate_inn(inn):
     return inn.isdigit() and len(inn) in [10, 12]
 
 def validate_phone(phone):
-    phone = phone.replace('+7', '8').replace(' ', '').replace('-', '').replace('(', '').replace(')', '')
-    return phone.isdigit() and len(phone) == 11 and phone.startswith('8')
-
-# Keyboards
-def get_role_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Dealer"), KeyboardButton(text="Buyer")]],
-        resize_keyboard=True
-    )
+    phone = phone.replace('+7', '8').translate(PHONE_STRIP)
+    # Length and first digit are O(1), so they run before the full isdigit scan
+    return len(phone) == 11 and phone[0] == '8' and phone.isdigit()
+
+# Keyboards (built once, shared by all handlers)
+ROLE_KB = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="Dealer"), KeyboardButton(text="Buyer")]],
+    resize_keyboard=True
+)
+
+ADMIN_MAIN_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="/addstock"), KeyboardButton(text="/mystock")],
+        [KeyboardButton(text="/search"), KeyboardButton(text="/deletestock")],
+        [KeyboardButton(text="/deleteitem"), KeyboardButton(text="/admin")],
+        [KeyboardButton(text="/help")]
+    ],
+    resize_keyboard=True
+)
+
+DEALER_MAIN_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="/addstock"), KeyboardButton(text="/mystock")],
+        [KeyboardButton(text="/search"), KeyboardButton(text="/deletestock")],
+        [KeyboardButton(text="/deleteitem"), KeyboardButton(text="/help")]
+    ],
+    resize_keyboard=True
+)
+
+BUYER_MAIN_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="/search"), KeyboardButton(text="/help")]
+    ],
+    resize_keyboard=True
+)
+
+MAIN_KB_BY_ROLE = {'Dealer': DEALER_MAIN_KB, 'Buyer': BUYER_MAIN_KB}
+
+def main_keyboard_for(telegram_id, role):
+    """Picks the prebuilt main keyboard when the role is already known"""
+    if is_admin(telegram_id):
+        return ADMIN_MAIN_KB
+    return MAIN_KB_BY_ROLE.get(role, BUYER_MAIN_KB)
 
 async def get_main_keyboard(telegram_id):
     """Returns keyboard based on user role"""
     
     if is_admin(telegram_id):
-        return ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="/addstock"), KeyboardButton(text="/mystock")],
-                [KeyboardButton(text="/search"), KeyboardButton(text="/deletestock")],
-                [KeyboardButton(text="/deleteitem"), KeyboardButton(text="/admin")],
-                [KeyboardButton(text="/help")]
-            ],
-            resize_keyboard=True
-        )
-    
-    user_role = await get_user_role(telegram_id)
-    
-    if user_role == 'Dealer':
-        return ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="/addstock"), KeyboardButton(text="/mystock")],
-                [KeyboardButton(text="/search"), KeyboardButton(text="/deletestock")],
-                [KeyboardButton(text="/deleteitem"), KeyboardButton(text="/help")]
-            ],
-            resize_keyboard=True
-        )
-    else:
-        return ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text="/search"), KeyboardButton(text="/help")]
-            ],
-            resize_keyboard=True
-        )
+        return ADMIN_MAIN_KB
+    
+    return MAIN_KB_BY_ROLE.get(await get_user_role(telegram_id), BUYER_MAIN_KB)
+
+HELP_ANON = (
+    "🤖 <b>Tyreterra Bot Help</b>\n\n"
+    "To start working with the bot:\n"
+    "1. Use /start to register\n"
+    "2. Choose your role (Dealer/Buyer)\n"
+    "3. Fill in your details\n\n"
+    "❌ Cancel any operation: /cancel\n"
+    "🆘 Help: /help"
+)
 
-def get_search_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="SKU"), KeyboardButton(text="Tyre Size")],
-            [KeyboardButton(text="Brand"), KeyboardButton(text="Warehouse")],
-            [KeyboardButton(text="All")]
-        ],
-        resize_keyboard=True
-    )
+HELP_BY_ROLE = {
+    'Dealer': (
+        "🤖 <b>Tyreterra Bot Help</b>\n\n"
+        "<b>Available commands:</b>\n"
+        "• /addstock - Add item to stock\n"
+        "• /quickadd - Add item in one line\n"
+        "• /mystock - Download your stock\n"
+        "• /search - Search in other users' stock\n"
+        "• /deletestock - Delete your entire stock\n"
+        "• /deleteitem - Delete specific item\n"
+        "• /help - This help\n\n"
+        "❌ Cancel any operation: /cancel"
+    ),
+    'Buyer': (
+        "🤖 <b>Tyreterra Bot Help</b>\n\n"
+        "<b>Available commands:</b>\n"
+        "• /search - Search in other users' stock\n"
+        "• /help - This help\n\n"
+        "❌ Cancel any operation: /cancel"
+    ),
+}
+
+HELP_UNKNOWN_ROLE = "Unknown role. Please contact administrator."
+
+SEARCH_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="SKU"), KeyboardButton(text="Tyre Size")],
+        [KeyboardButton(text="Brand"), KeyboardButton(text="Warehouse")],
+        [KeyboardButton(text="All")]
+    ],
+    resize_keyboard=True
+)
 
-def get_confirmation_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="Yes"), KeyboardButton(text="No")]],
-        resize_keyboard=True
-    )
+CONFIRM_KB = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="Yes"), KeyboardButton(text="No")]],
+    resize_keyboard=True
+)
 
-def get_admin_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="/admin_users"), KeyboardButton(text="/admin_stock")],
-            [KeyboardButton(text="/admin_stats"), KeyboardButton(text="/admin_export")],
-            [KeyboardButton(text="/admin_backup"), KeyboardButton(text="/admin_sql")],
-            [KeyboardButton(text="/admin_edit_user"), KeyboardButton(text="/admin_edit_stock")],
-            [KeyboardButton(text="/admin_delete_user"), KeyboardButton(text="/admin_delete_stock")],
-            [KeyboardButton(text="/admin_clear_cache"), KeyboardButton(text="/help")]
-        ],
-        resize_keyboard=True
-    )
+ADMIN_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="/admin_users"), KeyboardButton(text="/admin_stock")],
+        [KeyboardButton(text="/admin_stats"), KeyboardButton(text="/admin_export")],
+        [KeyboardButton(text="/admin_backup"), KeyboardButton(text="/admin_sql")],
+        [KeyboardButton(text="/admin_edit_user"), KeyboardButton(text="/admin_edit_stock")],
+        [KeyboardButton(text="/admin_delete_user"), KeyboardButton(text="/admin_delete_stock")],
+        [KeyboardButton(text="/admin_clear_cache"), KeyboardButton(text="/help")]
+    ],
+    resize_keyboard=True
+)
+
+SEARCH_COLUMNS = ['sku', 'tyre_size', 'tyre_pattern', 'brand', 'country',
+                  'qty_available', 'retail_price', 'wholesale_price', 'warehouse_location',
+                  'company_name', 'phone', 'email']
+
+# Buyers don't see wholesale price and other users' contacts
+BUYER_COLUMNS = ['sku', 'tyre_size', 'tyre_pattern', 'brand', 'country',
+                 'qty_available', 'retail_price', 'warehouse_location', 'company_name']
+
+SELECT_STOCK_FULL = """
+    SELECT s.sku, s.tyre_size, s.tyre_pattern, s.brand, s.country,
+           s.qty_available, s.retail_price, s.wholesale_price, s.warehouse_location,
+           u.company_name, u.phone, u.email
+    FROM stock s
+    JOIN users u ON s.user_id = u.id
+"""
+
+SELECT_STOCK_BUYER = """
+    SELECT s.sku, s.tyre_size, s.tyre_pattern, s.brand, s.country,
+           s.qty_available, s.retail_price, s.warehouse_location,
+           u.company_name
+    FROM stock s
+    JOIN users u ON s.user_id = u.id
+"""
+
+SEARCH_ALL_WHERE = """
+    WHERE u.telegram_id != ?
+    ORDER BY s.date DESC
+"""
+
+SEARCH_MATCH_WHERE = """
+    JOIN stock_fts f ON f.rowid = s.id
+    WHERE stock_fts MATCH ? AND u.telegram_id != ?
+    ORDER BY s.date DESC
+"""
+
+# Complete search statements keyed by (is_buyer, is_all): the SQL text never changes
+# between calls, so sqlite reuses the prepared statement from its cache
+SEARCH_QUERIES = {
+    (is_buyer, is_all): select + where
+    for is_buyer, select in ((False, SELECT_STOCK_FULL), (True, SELECT_STOCK_BUYER))
+    for is_all, where in ((False, SEARCH_MATCH_WHERE), (True, SEARCH_ALL_WHERE))
+}
+
+# Search type -> stock column the query is restricted to
+SEARCH_COLUMNS = {
+    "SKU": "sku",
+    "Tyre Size": "tyre_size",
+    "Brand": "brand",
+    "Warehouse": "warehouse_location",
+}
+
+# One matching rule per column. Brand and warehouse are words, so they go through
+# stock_fts by word prefix: "nok" finds "Nokian Tyres", "kian" does not.
+# SKUs and sizes are codes written run together ("AB123", "205/55R16"), so they
+# keep the substring LIKE: "123" finds "AB123", "R16" finds "205/55R16"
+SEARCH_FTS_COLUMNS = ('brand', 'warehouse_location')
+
+# Substring search on one column: keyed by (is_buyer, column)
+SEARCH_LIKE_QUERIES = {
+    (is_buyer, column): select + f"""
+    WHERE s.{column} LIKE ? AND u.telegram_id != ?
+    ORDER BY s.date DESC
+"""
+    for is_buyer, select in ((False, SELECT_STOCK_FULL), (True, SELECT_STOCK_BUYER))
+    for column in SEARCH_COLUMNS.values() if column not in SEARCH_FTS_COLUMNS
+}
+
+FTS_TOKEN_RE = re.compile(r'\w+')
+
+def build_fts_query(column, value):
+    """Turns user input into an FTS5 prefix query on one column, None if it has no words"""
+    # Each word is quoted, so FTS5 operators typed by the user are treated as plain text
+    tokens = FTS_TOKEN_RE.findall(value)
+    if not tokens:
+        return None
+    return f'{column} : (' + ' '.join(f'"{token}"*' for token in tokens) + ')'
+
+def write_xlsx(filename, columns, rows):
+    """Writes a header and rows to an xlsx file (blocking, run it in a thread)"""
+    # constant_memory flushes each row to disk as soon as the next one starts
+    wb = xlsxwriter.Workbook(filename, {'constant_memory': True, 'strings_to_numbers': False})
+    ws = wb.add_worksheet()
+    ws.write_row(0, 0, columns)
+    for row_num, row in enumerate(rows, 1):
+        ws.write_row(row_num, 0, row)
+    wb.close()
+
+def write_sheets_xlsx(filename, sheets):
+    """Writes {sheet name: (columns, rows)} to one xlsx file (blocking, run it in a thread)"""
+    # Rows go out in order with write_row: constant_memory only keeps the current row,
+    # so writing column by column (as DataFrame.to_excel does) would lose data
+    wb = xlsxwriter.Workbook(filename, {'constant_memory': True, 'strings_to_numbers': False})
+    for sheet_name, (columns, rows) in sheets.items():
+        ws = wb.add_worksheet(sheet_name)
+        ws.write_row(0, 0, columns)
+        write_rows(ws, 1, rows)
+    wb.close()
+
+def write_rows(ws, first_row, rows):
+    """Writes rows to a worksheet starting at first_row (blocking, run it in a thread)"""
+    for row_num, row in enumerate(rows, first_row):
+        ws.write_row(row_num, 0, row)
+
+async def export_query_xlsx(filename, query, params=(), columns=None):
+    """Streams a query result into an xlsx file batch by batch, returns the row count"""
+    wb = xlsxwriter.Workbook(filename, {'constant_memory': True, 'strings_to_numbers': False})
+    ws = wb.add_worksheet()
+    row_count = 0
+    try:
+        async for rows in db.fetch_batches(query, params):
+            if not row_count:
+                # Without explicit names the header comes from the result itself
+                ws.write_row(0, 0, columns or rows[0].keys())
+            await asyncio.to_thread(write_rows, ws, row_count + 1, rows)
+            row_count += len(rows)
+    finally:
+        await asyncio.to_thread(wb.close)
+    return row_count
 
 async def create_search_excel(stock_items, user_role, search_type="results"):
     """Creates Excel file with search results (hides wholesale price for buyers)"""
     if not stock_items:
         return None
     
-    if not os.path.exists('temp_files'):
-        os.makedirs('temp_files')
-    
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"temp_files/search_{timestamp}.xlsx"
+    timestamp = now_stamp()
+    filename = temp_path('search', timestamp)
     
-    # For buyers, hide wholesale price and other users' contacts
-    if user_role == 'Buyer':
-        columns = ['sku', 'tyre_size', 'tyre_pattern', 'brand', 'country', 
-                  'qty_available', 'retail_price', 'warehouse_location', 'company_name']
-        
-        processed_items = []
-        for item in stock_items:
-            processed_item = list(item[:6]) + [item[6]] + [item[8]] + [item[9]]  # Skip wholesale_price and contacts
-            processed_items.append(processed_item)
-        
-        df = pd.DataFrame(processed_items, columns=columns)
-    else:
-        # For dealers and admins, show all data
-        columns = ['sku', 'tyre_size', 'tyre_pattern', 'brand', 'country', 
-                  'qty_available', 'retail_price', 'wholesale_price', 'warehouse_location',
-                  'company_name', 'phone', 'email']
-        df = pd.DataFrame(stock_items, columns=columns)
-    
-    df.to_excel(filename, index=False, engine='openpyxl')
+    # Serialization runs off the event loop so other chats are not blocked
+    # Rows already come projected for the role, see SELECT_STOCK_BUYER
+    columns = BUYER_COLUMNS if user_role == 'Buyer' else SEARCH_COLUMNS
+    await asyncio.to_thread(write_xlsx, filename, columns, stock_items)
     return filename
 
 # =============================================================================
@@ -367,12 +907,12 @@ async def create_search_excel(stock_items, user_role, search_type="results"):
 
 @dp.message(Command("cancel"))
 async def cancel_handler(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
+    # Leaving a dialog is never rate limited, otherwise a throttled user is stuck in it
     current_state = await state.get_state()
     if current_state is None:
+        if check_rate_limit(message.from_user.id):
+            await message.answer(RATE_LIMIT_MSG)
+            return
         await message.answer("No active operations to cancel.")
         return
     
@@ -380,26 +920,22 @@ async def cancel_handler(message: Message, state: FSMContext):
     await message.answer("❌ Operation cancelled.", reply_markup=await get_main_keyboard(message.from_user.id))
 
 @dp.message(Command("start"))
+@rate_limited
 async def cmd_start(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     user_id = message.from_user.id
     user_name = message.from_user.full_name
     
-    user = await db.fetchone("SELECT * FROM users WHERE telegram_id = ?", (user_id,))
+    role = await get_user_role(user_id)
     
-    if not user:
+    if role is None:
         await message.answer(
             f"Welcome to Tyreterra, {user_name}!\n"
             "Let's register you in the system.\n"
             "Please choose your role:",
-            reply_markup=get_role_keyboard()
+            reply_markup=ROLE_KB
         )
         await state.set_state(Registration.waiting_for_role)
     else:
-        role = user[7]
         await message.answer(
             f"Welcome back, {user_name}!\n"
             f"Your role: {role}\n"
@@ -408,11 +944,8 @@ async def cmd_start(message: Message, state: FSMContext):
         )
 
 @dp.message(Registration.waiting_for_role)
+@rate_limited
 async def process_role(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text not in ["Dealer", "Buyer"]:
         await message.answer("Please choose a role from the suggested options:")
         return
@@ -422,21 +955,15 @@ async def process_role(message: Message, state: FSMContext):
     await state.set_state(Registration.waiting_for_company)
 
 @dp.message(Registration.waiting_for_company)
+@rate_limited
 async def process_company(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     await state.update_data(company_name=message.text)
     await message.answer("Enter your company TIN (10 or 12 digits):")
     await state.set_state(Registration.waiting_for_inn)
 
 @dp.message(Registration.waiting_for_inn)
+@rate_limited
 async def process_inn(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if not validate_inn(message.text):
         await message.answer("❌ Invalid TIN format. Enter 10 or 12 digits:")
         return
@@ -446,11 +973,8 @@ async def process_inn(message: Message, state: FSMContext):
     await state.set_state(Registration.waiting_for_phone)
 
 @dp.message(Registration.waiting_for_phone)
+@rate_limited
 async def process_phone(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if not validate_phone(message.text):
         await message.answer("❌ Invalid phone format. Enter in format 89991234567:")
         return
@@ -460,11 +984,8 @@ async def process_phone(message: Message, state: FSMContext):
     await state.set_state(Registration.waiting_for_email)
 
 @dp.message(Registration.waiting_for_email)
+@rate_limited
 async def process_email(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if not validate_email(message.text):
         await message.answer("❌ Invalid email format. Enter a valid email:")
         return
@@ -479,6 +1000,7 @@ async def process_email(message: Message, state: FSMContext):
             (message.from_user.id, user_data['name'], user_data['company_name'], 
              user_data['inn'], user_data['phone'], message.text, user_data['role'])
         )
+        cache.delete(f"user:{message.from_user.id}")
         
         role_permissions = ""
         if user_data['role'] == 'Dealer':
@@ -510,12 +1032,9 @@ async def process_email(message: Message, state: FSMContext):
 # =============================================================================
 
 @dp.message(Command("addstock"))
+@rate_limited
 async def cmd_addstock(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    user = await db.fetchone("SELECT id, role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_user(message.from_user.id)
     
     if not user:
         await message.answer("Please register first using /start")
@@ -540,146 +1059,100 @@ async def cmd_addstock(message: Message, state: FSMContext):
         "Enter the article (SKU):\n\n"
         "❌ To cancel enter /cancel"
     )
+    await state.update_data(user_id=user[0])
     await state.set_state(AddStock.waiting_for_sku)
 
 @dp.message(AddStock.waiting_for_sku)
+@rate_limited
 async def process_sku(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text == '/cancel':
         await cancel_handler(message, state)
         return
         
     await state.update_data(sku=message.text)
-    await message.answer("Enter tyre size (e.g.: 195/65 R15):\n\n❌ To cancel enter /cancel")
+    await message.answer(PROMPT_SIZE)
     await state.set_state(AddStock.waiting_for_size)
 
 @dp.message(AddStock.waiting_for_size)
+@rate_limited
 async def process_size(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text == '/cancel':
         await cancel_handler(message, state)
         return
         
     await state.update_data(tyre_size=message.text)
-    await message.answer("Enter tyre model (tyre pattern):\n\n❌ To cancel enter /cancel")
+    await message.answer(PROMPT_PATTERN)
     await state.set_state(AddStock.waiting_for_pattern)
 
 @dp.message(AddStock.waiting_for_pattern)
+@rate_limited
 async def process_pattern(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text == '/cancel':
         await cancel_handler(message, state)
         return
         
     await state.update_data(tyre_pattern=message.text)
-    await message.answer("Enter tyre brand:\n\n❌ To cancel enter /cancel")
+    await message.answer(PROMPT_BRAND)
     await state.set_state(AddStock.waiting_for_brand)
 
 @dp.message(AddStock.waiting_for_brand)
+@rate_limited
 async def process_brand(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text == '/cancel':
         await cancel_handler(message, state)
         return
         
     await state.update_data(brand=message.text)
-    await message.answer("Enter country of origin:\n\n❌ To cancel enter /cancel")
+    await message.answer(PROMPT_COUNTRY)
     await state.set_state(AddStock.waiting_for_country)
 
 @dp.message(AddStock.waiting_for_country)
+@rate_limited
 async def process_country(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text == '/cancel':
         await cancel_handler(message, state)
         return
         
     await state.update_data(country=message.text)
-    await message.answer("Enter available quantity (numbers only):\n\n❌ To cancel enter /cancel")
-    await state.set_state(AddStock.waiting_for_qty)
+    await message.answer(QTY_PRICES_PROMPT)
+    await state.set_state(AddStock.waiting_for_qty_prices)
 
-@dp.message(AddStock.waiting_for_qty)
-async def process_qty(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    if message.text == '/cancel':
-        await cancel_handler(message, state)
-        return
-        
-    try:
-        qty = int(message.text)
-        if qty <= 0:
-            await message.answer("Quantity must be a positive number. Try again:\n\n❌ To cancel enter /cancel")
-            return
-        await state.update_data(qty_available=qty)
-        await message.answer("Enter retail price (numbers only):\n\n❌ To cancel enter /cancel")
-        await state.set_state(AddStock.waiting_for_retail_price)
-    except ValueError:
-        await message.answer("Please enter a valid number for quantity:\n\n❌ To cancel enter /cancel")
+QTY_PRICES_RE = re.compile(r'(\d+)\s+(\d+(?:\.\d+)?)\s+(\d+(?:\.\d+)?)')
 
-@dp.message(AddStock.waiting_for_retail_price)
-async def process_retail_price(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
+QTY_PRICES_PROMPT = (
+    "Enter quantity, retail price and wholesale price separated by spaces.\n"
+    "Example: 8 5200 4700\n\n"
+    "❌ To cancel enter /cancel"
+)
+
+@dp.message(AddStock.waiting_for_qty_prices)
+@rate_limited
+async def process_qty_prices(message: Message, state: FSMContext):
     if message.text == '/cancel':
         await cancel_handler(message, state)
         return
         
-    try:
-        retail_price = float(message.text)
-        if retail_price <= 0:
-            await message.answer("Price must be a positive number. Try again:\n\n❌ To cancel enter /cancel")
-            return
-        await state.update_data(retail_price=retail_price)
-        await message.answer("Enter wholesale price (numbers only):\n\n❌ To cancel enter /cancel")
-        await state.set_state(AddStock.waiting_for_wholesale_price)
-    except ValueError:
-        await message.answer("Please enter a valid number for price:\n\n❌ To cancel enter /cancel")
-
-@dp.message(AddStock.waiting_for_wholesale_price)
-async def process_wholesale_price(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
+    # One step for all three numbers instead of three prompts with their own parsing
+    match = QTY_PRICES_RE.fullmatch(message.text.strip())
+    if not match:
+        await message.answer("Please enter three numbers.\n\n" + QTY_PRICES_PROMPT)
         return
-        
-    if message.text == '/cancel':
-        await cancel_handler(message, state)
+    
+    qty = int(match[1])
+    retail_price = float(match[2])
+    wholesale_price = float(match[3])
+    
+    if qty <= 0 or retail_price <= 0 or wholesale_price <= 0:
+        await message.answer("Quantity and prices must be positive numbers. Try again:\n\n❌ To cancel enter /cancel")
         return
-        
-    try:
-        wholesale_price = float(message.text)
-        if wholesale_price <= 0:
-            await message.answer("Price must be a positive number. Try again:\n\n❌ To cancel enter /cancel")
-            return
-        await state.update_data(wholesale_price=wholesale_price)
-        await message.answer("Enter warehouse location:\n\n❌ To cancel enter /cancel")
-    except ValueError:
-        await message.answer("Please enter a valid number for price:\n\n❌ To cancel enter /cancel")
+    
+    await state.update_data(qty_available=qty, retail_price=retail_price, wholesale_price=wholesale_price)
+    await message.answer(PROMPT_WAREHOUSE)
+    await state.set_state(AddStock.waiting_for_warehouse)
 
 @dp.message(AddStock.waiting_for_warehouse)
+@rate_limited
 async def process_warehouse(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text == '/cancel':
         await cancel_handler(message, state)
         return
@@ -688,15 +1161,11 @@ async def process_warehouse(message: Message, state: FSMContext):
         user_data = await state.get_data()
         await state.clear()
         
-        user = await db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (message.from_user.id,))
+        user_id = user_data.get('user_id')
         
-        if user:
-            user_id = user[0]
-            
+        if user_id is not None:
             await db.execute(
-                """INSERT INTO stock 
-                (user_id, sku, tyre_size, tyre_pattern, brand, country, qty_available, retail_price, wholesale_price, warehouse_location) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                SQL_INSERT_STOCK,
                 (user_id, user_data['sku'], user_data['tyre_size'], user_data['tyre_pattern'],
                  user_data['brand'], user_data['country'], user_data['qty_available'],
                  user_data['retail_price'], user_data['wholesale_price'], message.text)
@@ -723,12 +1192,73 @@ async def process_warehouse(message: Message, state: FSMContext):
         await state.clear()
         await message.answer("❌ An error occurred while adding the item. Please try again.")
 
+QUICKADD_USAGE = (
+    "Usage (one line, fields separated by |):\n"
+    "/quickadd sku|size|pattern|brand|country|qty|retail|wholesale|warehouse\n\n"
+    "Example:\n"
+    "/quickadd A123|195/65 R15|Nordman 7|Nokian|Finland|8|5200|4700|Moscow"
+)
+
+@dp.message(Command("quickadd"))
+@rate_limited
+async def cmd_quickadd(message: Message):
+    """Adds one item from a single line instead of the nine-step dialog"""
+    user = await get_user(message.from_user.id)
+    
+    if not user:
+        await message.answer("Please register first using /start")
+        return
+    
+    user_id, role = user
+    
+    if role != 'Dealer':
+        await message.answer("❌ Only dealers can add items to stock")
+        return
+    
+    if await db.get_user_stock_count(user_id) >= MAX_STOCK_ITEMS:
+        await message.answer(f"❌ Item limit reached ({MAX_STOCK_ITEMS}). Delete some items to add new ones.")
+        return
+    
+    args = message.text.split(maxsplit=1)
+    fields = [field.strip() for field in args[1].split('|')] if len(args) > 1 else []
+    
+    if len(fields) != 9 or not all(fields):
+        await message.answer(QUICKADD_USAGE)
+        return
+    
+    sku, tyre_size, tyre_pattern, brand, country, qty, retail_price, wholesale_price, warehouse = fields
+    
+    try:
+        qty = int(qty)
+        retail_price = float(retail_price)
+        wholesale_price = float(wholesale_price)
+    except ValueError:
+        await message.answer("❌ Quantity and prices must be numbers.\n\n" + QUICKADD_USAGE)
+        return
+    
+    if qty <= 0 or retail_price <= 0 or wholesale_price <= 0:
+        await message.answer("❌ Quantity and prices must be positive numbers.")
+        return
+    
+    try:
+        await db.execute(
+            SQL_INSERT_STOCK,
+            (user_id, sku, tyre_size, tyre_pattern, brand, country,
+             qty, retail_price, wholesale_price, warehouse)
+        )
+    except Exception as e:
+        logger.error(f"Quick add error: {e}")
+        await message.answer("❌ An error occurred while adding the item. Please try again.")
+        return
+    
+    await message.answer(
+        f"✅ Item {sku} added: {brand} {tyre_size}, {qty} pcs.",
+        reply_markup=await get_main_keyboard(message.from_user.id)
+    )
+
 @dp.message(Command("mystock"))
+@rate_limited(weight=HEAVY_REQUEST_WEIGHT)
 async def cmd_mystock(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     try:
         user = await db.fetchone("SELECT id, name, role FROM users WHERE telegram_id = ?", (message.from_user.id,))
         
@@ -742,20 +1272,25 @@ async def cmd_mystock(message: Message):
             await message.answer("❌ Only dealers can download their stock")
             return
         
-        cache_key = f"mystock_{user_id}"
-        cached_data = cache.get(cache_key)
-        
-        if cached_data:
-            filename, stock_count = cached_data
-            if os.path.exists(filename):
-                with open(filename, 'rb') as file:
-                    await message.answer_document(
-                        document=types.BufferedInputFile(file.read(), filename=f"my_stock_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"),
-                        caption=f"📊 Your stock ({stock_count} items) [CACHE]\n👤 User: {user_name}"
-                    )
-                return
+        # The version is bumped by triggers on every insert, update and delete of the user's stock
+        stock_count, version = await db.fetchone(SQL_STOCK_VERSION, (user_id,))
+        
+        if not stock_count:
+            await message.answer("Your stock is empty. Use /addstock to add items.")
+            return
+        
+        filename = f"temp_files/stock_{user_id}_v{version or 0}_{stock_count}.xlsx"
+        download_name = f"my_stock_{time.strftime('%Y%m%d_%H%M')}.xlsx"
+        
+        if os.path.exists(filename):
+            # Bump mtime so the cleaner treats a reused file as recently used
+            os.utime(filename)
+            await message.answer_document(
+                document=types.FSInputFile(filename, filename=download_name),
+                caption=f"📊 Your stock ({stock_count} items) [CACHE]\n👤 User: {user_name}"
+            )
+            return
         
-        # FIXED QUERY - select ALL 10 columns
         stock_items = await db.fetchall(
             """SELECT sku, tyre_size, tyre_pattern, brand, country, qty_available, 
                       retail_price, wholesale_price, warehouse_location, date 
@@ -763,42 +1298,28 @@ async def cmd_mystock(message: Message):
             (user_id,)
         )
         
-        if not stock_items:
-            await message.answer("Your stock is empty. Use /addstock to add items.")
-            return
-        
-        if not os.path.exists('temp_files'):
-            os.makedirs('temp_files')
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"temp_files/stock_{user_id}_{timestamp}.xlsx"
-        
-        # FIXED DATAFRAME CREATION
         columns = ['sku', 'tyre_size', 'tyre_pattern', 'brand', 'country', 
                   'qty_available', 'retail_price', 'wholesale_price', 'warehouse_location', 'date']
         
-        df = pd.DataFrame(stock_items, columns=columns)
-        df.to_excel(filename, index=False, engine='openpyxl')
-        
-        cache.set(cache_key, (filename, len(stock_items)))
+        # Write under a temporary name so a concurrent request never sends a half-written file
+        partial = f"{filename}.{uuid.uuid4().hex}.part"
+        await asyncio.to_thread(write_xlsx, partial, columns, stock_items)
+        os.replace(partial, filename)
         
-        with open(filename, 'rb') as file:
-            await message.answer_document(
-                document=types.BufferedInputFile(file.read(), filename=f"my_stock_{timestamp}.xlsx"),
-                caption=f"📊 Your stock ({len(stock_items)} items)\n👤 User: {user_name}"
-            )
+        # FSInputFile streams the file from disk instead of reading it into memory
+        await message.answer_document(
+            document=types.FSInputFile(filename, filename=download_name),
+            caption=f"📊 Your stock ({len(stock_items)} items)\n👤 User: {user_name}"
+        )
             
     except Exception as e:
         logger.error(f"Error in mystock: {e}")
         await message.answer(f"❌ Error downloading stock: {str(e)}")
 
 @dp.message(Command("deletestock"))
+@rate_limited
 async def cmd_deletestock(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    user = await db.fetchone("SELECT id, role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_user(message.from_user.id)
     
     if not user:
         await message.answer("Please register first using /start")
@@ -810,34 +1331,31 @@ async def cmd_deletestock(message: Message, state: FSMContext):
         await message.answer("❌ Only dealers can delete their stock")
         return
     
-    stock_count = await db.fetchone("SELECT COUNT(*) FROM stock WHERE user_id = ?", (user_id,))
+    stock_count = await db.get_user_stock_count(user_id)
     
-    if not stock_count or stock_count[0] == 0:
+    if stock_count == 0:
         await message.answer("❌ Your stock is already empty.")
         return
     
     await message.answer(
-        f"⚠️ WARNING: You are about to delete your ENTIRE stock ({stock_count[0]} items).\n"
+        f"⚠️ WARNING: You are about to delete your ENTIRE stock ({stock_count} items).\n"
         "This action CANNOT be undone!\n\n"
         "Are you sure you want to continue?\n\n"
         "❌ To cancel enter /cancel",
-        reply_markup=get_confirmation_keyboard()
+        reply_markup=CONFIRM_KB
     )
+    await state.update_data(user_id=user_id)
     await state.set_state(DeleteAllStock.confirmation)
 
 @dp.message(DeleteAllStock.confirmation)
+@rate_limited
 async def process_delete_all_confirmation(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text == '/cancel':
         await cancel_handler(message, state)
         return
-    
+        
     if message.text == 'Yes':
-        user = await db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (message.from_user.id,))
-        user_id = user[0]
+        user_id = (await state.get_data())['user_id']
         
         await db.execute("DELETE FROM stock WHERE user_id = ?", (user_id,))
         
@@ -857,12 +1375,9 @@ async def process_delete_all_confirmation(message: Message, state: FSMContext):
     await state.clear()
 
 @dp.message(Command("deleteitem"))
+@rate_limited
 async def cmd_deleteitem(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    user = await db.fetchone("SELECT id, role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_user(message.from_user.id)
     
     if not user:
         await message.answer("Please register first using /start")
@@ -879,24 +1394,21 @@ async def cmd_deleteitem(message: Message, state: FSMContext):
         "❌ To cancel enter /cancel",
         reply_markup=await get_main_keyboard(message.from_user.id)
     )
+    await state.update_data(user_id=user_id)
     await state.set_state(DeleteItem.waiting_for_sku)
 
 @dp.message(DeleteItem.waiting_for_sku)
+@rate_limited
 async def process_delete_sku(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text == '/cancel':
         await cancel_handler(message, state)
         return
-    
+        
     sku = message.text
-    user = await db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (message.from_user.id,))
-    user_id = user[0]
+    user_id = (await state.get_data())['user_id']
     
     item = await db.fetchone(
-        "SELECT * FROM stock WHERE user_id = ? AND sku = ?", 
+        "SELECT sku, tyre_size, brand, qty_available FROM stock WHERE user_id = ? AND sku = ? LIMIT 1",
         (user_id, sku)
     )
     
@@ -912,42 +1424,40 @@ async def process_delete_sku(message: Message, state: FSMContext):
     
     await message.answer(
         f"Found item:\n"
-        f"🏷️ SKU: {item[2]}\n"
-        f"📏 Size: {item[3]}\n"
-        f"🏭 Brand: {item[5]}\n"
-        f"📊 Quantity: {item[7]}\n\n"
+        f"🏷️ SKU: {item['sku']}\n"
+        f"📏 Size: {item['tyre_size']}\n"
+        f"🏭 Brand: {item['brand']}\n"
+        f"📊 Quantity: {item['qty_available']}\n\n"
         f"Are you sure you want to delete this item?\n\n"
         "❌ To cancel enter /cancel",
-        reply_markup=get_confirmation_keyboard()
+        reply_markup=CONFIRM_KB
     )
     await state.set_state(DeleteItem.confirmation)
 
 @dp.message(DeleteItem.confirmation)
+@rate_limited
 async def process_delete_confirmation(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text == '/cancel':
         await cancel_handler(message, state)
         return
-    
+        
     if message.text == 'Yes':
         user_data = await state.get_data()
-        sku = user_data['sku']
-        
-        user = await db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (message.from_user.id,))
-        user_id = user[0]
+        sku, user_id = user_data['sku'], user_data['user_id']
         
-        await db.execute(
-            "DELETE FROM stock WHERE user_id = ? AND sku = ?", 
-            (user_id, sku)
-        )
+        # RETURNING reports what was actually removed in the same statement
+        deleted = await db.execute_returning(SQL_DELETE_STOCK_ITEM, (user_id, sku))
         
-        await message.answer(
-            f"✅ Item with SKU '{sku}' successfully deleted!",
-            reply_markup=await get_main_keyboard(message.from_user.id)
-        )
+        if deleted:
+            await message.answer(
+                f"✅ Item with SKU '{sku}' successfully deleted!",
+                reply_markup=await get_main_keyboard(message.from_user.id)
+            )
+        else:
+            await message.answer(
+                f"❌ Item with SKU '{sku}' is no longer in your stock.",
+                reply_markup=await get_main_keyboard(message.from_user.id)
+            )
     elif message.text == 'No':
         await message.answer(
             "❌ Item deletion cancelled.",
@@ -964,12 +1474,9 @@ async def process_delete_confirmation(message: Message, state: FSMContext):
 # =============================================================================
 
 @dp.message(Command("search"))
+@rate_limited
 async def cmd_search(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    user = await db.fetchone("SELECT id, role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_user(message.from_user.id)
     
     if not user:
         await message.answer("Please register first using /start")
@@ -977,16 +1484,17 @@ async def cmd_search(message: Message, state: FSMContext):
     
     await message.answer(
         "Choose search type:",
-        reply_markup=get_search_keyboard()
+        reply_markup=SEARCH_KB
     )
     await state.set_state(SearchStock.waiting_for_search_type)
 
+def search_type_weight(message):
+    # Picking "All" runs the search right away, so it pays the heavy weight here
+    return HEAVY_REQUEST_WEIGHT if message.text == "All" else 1
+
 @dp.message(SearchStock.waiting_for_search_type)
+@rate_limited(weight=search_type_weight)
 async def process_search_type(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text not in ["SKU", "Tyre Size", "Brand", "Warehouse", "All"]:
         await message.answer("Please choose a search type from the suggested options:")
         return
@@ -994,17 +1502,15 @@ async def process_search_type(message: Message, state: FSMContext):
     await state.update_data(search_type=message.text)
     
     if message.text == "All":
-        await process_search_value(message, state)
+        # Undecorated body: this message has already been charged once above
+        await process_search_value.__wrapped__(message, state)
     else:
         await message.answer(f"Enter {message.text} to search:\n\n❌ To cancel enter /cancel", reply_markup=ReplyKeyboardRemove())
         await state.set_state(SearchStock.waiting_for_search_value)
 
 @dp.message(SearchStock.waiting_for_search_value)
+@rate_limited(weight=HEAVY_REQUEST_WEIGHT)
 async def process_search_value(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text == '/cancel':
         await cancel_handler(message, state)
         return
@@ -1014,43 +1520,25 @@ async def process_search_value(message: Message, state: FSMContext):
         search_type = user_data['search_type']
         search_value = message.text
         
-        user = await db.fetchone("SELECT id, role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+        user = await get_user(message.from_user.id)
         user_role = user[1]
         
-        # Build query based on search type
+        # Buyers only get the columns they are allowed to see
+        is_buyer = user_role == 'Buyer'
+        
         if search_type == "All":
-            query = """
-                SELECT s.sku, s.tyre_size, s.tyre_pattern, s.brand, s.country, 
-                       s.qty_available, s.retail_price, s.wholesale_price, s.warehouse_location,
-                       u.company_name, u.phone, u.email
-                FROM stock s
-                JOIN users u ON s.user_id = u.id
-                WHERE u.telegram_id != ?
-                ORDER BY s.date DESC
-            """
-            params = (message.from_user.id,)
+            stock_items = await db.fetchall(SEARCH_QUERIES[(is_buyer, True)], (message.from_user.id,))
         else:
-            if search_type == "SKU":
-                where_clause = "s.sku LIKE ?"
-            elif search_type == "Tyre Size":
-                where_clause = "s.tyre_size LIKE ?"
-            elif search_type == "Brand":
-                where_clause = "s.brand LIKE ?"
-            elif search_type == "Warehouse":
-                where_clause = "s.warehouse_location LIKE ?"
-            
-            query = f"""
-                SELECT s.sku, s.tyre_size, s.tyre_pattern, s.brand, s.country, 
-                       s.qty_available, s.retail_price, s.wholesale_price, s.warehouse_location,
-                       u.company_name, u.phone, u.email
-                FROM stock s
-                JOIN users u ON s.user_id = u.id
-                WHERE {where_clause} AND u.telegram_id != ?
-                ORDER BY s.date DESC
-            """
-            params = (f"%{search_value}%", message.from_user.id)
-        
-        stock_items = await db.fetchall(query, params)
+            column = SEARCH_COLUMNS[search_type]
+            if column in SEARCH_FTS_COLUMNS:
+                # Word-prefix match through the FTS index instead of a LIKE '%...%' scan
+                match = build_fts_query(column, search_value)
+                stock_items = await db.fetchall(SEARCH_QUERIES[(is_buyer, False)], (match, message.from_user.id)) if match else []
+            else:
+                stock_items = await db.fetchall(
+                    SEARCH_LIKE_QUERIES[(is_buyer, column)],
+                    (f"%{search_value}%", message.from_user.id)
+                )
         
         if not stock_items:
             await message.answer(
@@ -1066,13 +1554,12 @@ async def process_search_value(message: Message, state: FSMContext):
         filename = await create_search_excel(stock_items, user_role, f"{search_type}_{search_value}")
         
         if filename:
-            with open(filename, 'rb') as file:
-                await message.answer_document(
-                    document=types.BufferedInputFile(file.read(), filename=f"search_results_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"),
-                    caption=f"🔍 Search results: {len(stock_items)} items found\n"
-                           f"Type: {search_type}\n"
-                           f"Value: {search_value if search_type != 'All' else 'All items'}"
-                )
+            await message.answer_document(
+                document=types.FSInputFile(filename, filename=f"search_results_{time.strftime('%Y%m%d_%H%M')}.xlsx"),
+                caption=f"🔍 Search results: {len(stock_items)} items found\n"
+                       f"Type: {search_type}\n"
+                       f"Value: {search_value if search_type != 'All' else 'All items'}"
+            )
         else:
             await message.answer("❌ Error creating file with search results")
         
@@ -1092,15 +1579,9 @@ async def process_search_value(message: Message, state: FSMContext):
 # =============================================================================
 
 @dp.message(Command("admin"))
+@rate_limited
+@admin_required
 async def cmd_admin(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ Access denied. Admin only.")
-        return
-    
     await message.answer(
         "🛠️ <b>Admin Panel</b>\n\n"
         "Available commands:\n"
@@ -1115,124 +1596,86 @@ async def cmd_admin(message: Message):
         "• /admin_delete_user - Delete user\n"
         "• /admin_delete_stock - Delete stock item\n"
         "• /admin_clear_cache - Clear cache",
-        reply_markup=get_admin_keyboard()
+        reply_markup=ADMIN_KB
     )
 
 @dp.message(Command("admin_users"))
+@rate_limited
+@admin_required
 async def cmd_admin_users(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ Access denied. Admin only.")
-        return
-    
     try:
-        users = await db.fetchall("SELECT * FROM users ORDER BY created_at DESC")
+        users = await db.fetchall(SQL_ADMIN_USERS)
         
         if not users:
             await message.answer("❌ No users found.")
             return
         
-        if not os.path.exists('temp_files'):
-            os.makedirs('temp_files')
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"temp_files/users_{timestamp}.xlsx"
+        timestamp = now_stamp()
+        filename = temp_path('users', timestamp)
         
         columns = ['id', 'telegram_id', 'name', 'company_name', 'inn', 'phone', 'email', 'role', 'created_at']
-        df = pd.DataFrame(users, columns=columns)
-        df.to_excel(filename, index=False, engine='openpyxl')
+        await asyncio.to_thread(write_sheets_xlsx, filename, {'Sheet1': (columns, users)})
         
-        with open(filename, 'rb') as file:
-            await message.answer_document(
-                document=types.BufferedInputFile(file.read(), filename=f"users_{timestamp}.xlsx"),
-                caption=f"👥 Users list: {len(users)} users"
-            )
+        await message.answer_document(
+            document=types.FSInputFile(filename, filename=f"users_{timestamp}.xlsx"),
+            caption=f"👥 Users list: {len(users)} users"
+        )
             
     except Exception as e:
         logger.error(f"Admin users error: {e}")
         await message.answer(f"❌ Error: {str(e)}")
 
 @dp.message(Command("admin_stock"))
+@rate_limited
+@admin_required
 async def cmd_admin_stock(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ Access denied. Admin only.")
-        return
-    
     try:
-        stock_items = await db.fetchall("""
-            SELECT s.*, u.name, u.company_name, u.phone, u.email 
-            FROM stock s 
-            JOIN users u ON s.user_id = u.id 
-            ORDER BY s.date DESC
-        """)
-        
-        if not stock_items:
-            await message.answer("❌ No stock items found.")
-            return
-        
-        if not os.path.exists('temp_files'):
-            os.makedirs('temp_files')
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"temp_files/all_stock_{timestamp}.xlsx"
+        timestamp = now_stamp()
+        filename = temp_path('all_stock', timestamp)
         
         columns = ['id', 'user_id', 'sku', 'tyre_size', 'tyre_pattern', 'brand', 'country', 
                   'qty_available', 'retail_price', 'wholesale_price', 'warehouse_location', 'date',
                   'user_name', 'company_name', 'phone', 'email']
-        df = pd.DataFrame(stock_items, columns=columns)
-        df.to_excel(filename, index=False, engine='openpyxl')
         
-        with open(filename, 'rb') as file:
-            await message.answer_document(
-                document=types.BufferedInputFile(file.read(), filename=f"all_stock_{timestamp}.xlsx"),
-                caption=f"📊 All stock: {len(stock_items)} items"
-            )
+        # Rows go from the cursor to the file in batches, the full table is never in memory
+        row_count = await export_query_xlsx(filename, SQL_ADMIN_ALL_STOCK, columns=columns)
+        
+        if not row_count:
+            os.remove(filename)
+            await message.answer("❌ No stock items found.")
+            return
+        
+        await message.answer_document(
+            document=types.FSInputFile(filename, filename=f"all_stock_{timestamp}.xlsx"),
+            caption=f"📊 All stock: {row_count} items"
+        )
             
     except Exception as e:
         logger.error(f"Admin stock error: {e}")
         await message.answer(f"❌ Error: {str(e)}")
 
 @dp.message(Command("admin_stats"))
+@rate_limited
+@admin_required
 async def cmd_admin_stats(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ Access denied. Admin only.")
-        return
-    
     try:
-        # Get statistics
-        total_users = await db.fetchone("SELECT COUNT(*) FROM users")
-        total_dealers = await db.fetchone("SELECT COUNT(*) FROM users WHERE role = 'Dealer'")
-        total_buyers = await db.fetchone("SELECT COUNT(*) FROM users WHERE role = 'Buyer'")
-        total_stock = await db.fetchone("SELECT COUNT(*) FROM stock")
-        total_stock_value = await db.fetchone("SELECT SUM(retail_price * qty_available) FROM stock")
-        avg_stock_per_dealer = await db.fetchone("SELECT AVG(stock_count) FROM (SELECT COUNT(*) as stock_count FROM stock GROUP BY user_id)")
-        
-        # Recent activity
-        recent_users = await db.fetchone("SELECT COUNT(*) FROM users WHERE created_at > datetime('now', '-7 days')")
-        recent_stock = await db.fetchone("SELECT COUNT(*) FROM stock WHERE date > datetime('now', '-7 days')")
+        # One pass over each table instead of eight separate queries
+        users = await db.fetchone(SQL_USER_STATS)
+        stock = await db.fetchone(SQL_STOCK_STATS)
+        
+        avg_stock_per_dealer = stock['total'] / stock['owners'] if stock['owners'] else 0
         
         stats_text = (
             "📊 <b>System Statistics</b>\n\n"
-            f"👥 <b>Users:</b> {total_users[0]}\n"
-            f"   • Dealers: {total_dealers[0]}\n"
-            f"   • Buyers: {total_buyers[0]}\n"
-            f"📦 <b>Stock items:</b> {total_stock[0]}\n"
-            f"💰 <b>Total stock value:</b> {total_stock_value[0] or 0:.2f} rub.\n"
-            f"📈 <b>Avg items per dealer:</b> {avg_stock_per_dealer[0] or 0:.1f}\n\n"
+            f"👥 <b>Users:</b> {users['total']}\n"
+            f"   • Dealers: {users['dealers'] or 0}\n"
+            f"   • Buyers: {users['buyers'] or 0}\n"
+            f"📦 <b>Stock items:</b> {stock['total']}\n"
+            f"💰 <b>Total stock value:</b> {stock['value'] or 0:.2f} rub.\n"
+            f"📈 <b>Avg items per dealer:</b> {avg_stock_per_dealer:.1f}\n\n"
             f"🔄 <b>Last 7 days:</b>\n"
-            f"   • New users: {recent_users[0]}\n"
-            f"   • New stock: {recent_stock[0]}"
+            f"   • New users: {users['recent'] or 0}\n"
+            f"   • New stock: {stock['recent'] or 0}"
         )
         
         await message.answer(stats_text)
@@ -1242,89 +1685,66 @@ async def cmd_admin_stats(message: Message):
         await message.answer(f"❌ Error: {str(e)}")
 
 @dp.message(Command("admin_export"))
+@rate_limited
+@admin_required
 async def cmd_admin_export(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ Access denied. Admin only.")
-        return
-    
     try:
         # Get all data
-        users = await db.fetchall("SELECT * FROM users")
-        stock = await db.fetchall("SELECT * FROM stock")
+        users = await db.fetchall(SQL_EXPORT_USERS)
+        stock = await db.fetchall(SQL_EXPORT_STOCK)
         
-        if not os.path.exists('temp_files'):
-            os.makedirs('temp_files')
+        timestamp = now_stamp()
+        filename = temp_path('full_export', timestamp)
         
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"temp_files/full_export_{timestamp}.xlsx"
+        sheets = {}
+        if users:
+            sheets['Users'] = (['id', 'telegram_id', 'name', 'company_name', 'inn', 'phone', 'email', 'role', 'created_at'], users)
+        if stock:
+            sheets['Stock'] = (['id', 'user_id', 'sku', 'tyre_size', 'tyre_pattern', 'brand', 'country', 
+                                'qty_available', 'retail_price', 'wholesale_price', 'warehouse_location', 'date'], stock)
         
-        with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-            # Users sheet
-            if users:
-                users_df = pd.DataFrame(users, columns=['id', 'telegram_id', 'name', 'company_name', 'inn', 'phone', 'email', 'role', 'created_at'])
-                users_df.to_excel(writer, sheet_name='Users', index=False)
-            
-            # Stock sheet
-            if stock:
-                stock_df = pd.DataFrame(stock, columns=['id', 'user_id', 'sku', 'tyre_size', 'tyre_pattern', 'brand', 'country', 
-                                                       'qty_available', 'retail_price', 'wholesale_price', 'warehouse_location', 'date'])
-                stock_df.to_excel(writer, sheet_name='Stock', index=False)
+        # Building and writing the workbook would otherwise stall every other chat
+        await asyncio.to_thread(write_sheets_xlsx, filename, sheets)
         
-        with open(filename, 'rb') as file:
-            await message.answer_document(
-                document=types.BufferedInputFile(file.read(), filename=f"full_export_{timestamp}.xlsx"),
-                caption=f"📁 Full data export\n👥 Users: {len(users) if users else 0}\n📦 Stock: {len(stock) if stock else 0}"
-            )
+        await message.answer_document(
+            document=types.FSInputFile(filename, filename=f"full_export_{timestamp}.xlsx"),
+            caption=f"📁 Full data export\n👥 Users: {len(users) if users else 0}\n📦 Stock: {len(stock) if stock else 0}"
+        )
             
     except Exception as e:
         logger.error(f"Admin export error: {e}")
         await message.answer(f"❌ Error: {str(e)}")
 
 @dp.message(Command("admin_backup"))
+@rate_limited
+@admin_required
 async def cmd_admin_backup(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ Access denied. Admin only.")
-        return
+    timestamp = now_stamp()
+    backup_filename = temp_path('tyreterra_backup', timestamp, 'db')
     
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_filename = f"tyreterra_backup_{timestamp}.db"
-        
-        shutil.copy2(DB_PATH, backup_filename)
+        # Online backup runs in sqlite's thread and is consistent even with writes in flight
+        await db.backup(backup_filename)
         
-        with open(backup_filename, 'rb') as file:
-            await message.answer_document(
-                document=types.BufferedInputFile(file.read(), filename=backup_filename),
-                caption="💾 Database backup created successfully"
-            )
-        
-        os.remove(backup_filename)
+        await message.answer_document(
+            document=types.FSInputFile(backup_filename, filename=f"tyreterra_backup_{timestamp}.db"),
+            caption="💾 Database backup created successfully"
+        )
         
     except Exception as e:
         logger.error(f"Admin backup error: {e}")
         await message.answer(f"❌ Error creating backup: {str(e)}")
+    finally:
+        if os.path.exists(backup_filename):
+            os.remove(backup_filename)
 
 @dp.message(Command("admin_clear_cache"))
+@rate_limited
+@admin_required
 async def cmd_admin_clear_cache(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ Access denied. Admin only.")
-        return
-    
     try:
         cache.clear()
-        cleanup_temp_files()
+        await asyncio.to_thread(cleanup_temp_files)
         await message.answer("✅ Cache cleared successfully!")
         
     except Exception as e:
@@ -1332,15 +1752,9 @@ async def cmd_admin_clear_cache(message: Message):
         await message.answer(f"❌ Error clearing cache: {str(e)}")
 
 @dp.message(Command("admin_sql"))
+@rate_limited
+@admin_required
 async def cmd_admin_sql(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ Access denied. Admin only.")
-        return
-    
     await message.answer(
         "Enter SQL query to execute:\n\n"
         "⚠️ <b>WARNING:</b> Be careful with modifying queries!\n"
@@ -1350,42 +1764,41 @@ async def cmd_admin_sql(message: Message, state: FSMContext):
     await state.set_state(AdminPanel.waiting_for_sql_query)
 
 @dp.message(AdminPanel.waiting_for_sql_query)
+@rate_limited
 async def process_admin_sql(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     if message.text == '/cancel':
         await cancel_handler(message, state)
         return
-    
+        
     try:
         query = message.text.strip()
         
-        if query.lower().startswith('select'):
-            result = await db.fetchall(query)
+        # Unterminated quotes or comments are rejected before reaching a connection
+        if not sqlite3.complete_statement(query + ';'):
+            await message.answer("❌ SQL error: incomplete statement")
+            await state.clear()
+            return
+        
+        if ADMIN_READ_SQL_RE.match(query):
+            timestamp = now_stamp()
+            filename = temp_path('sql_result', timestamp)
             
-            if not result:
+            row_count = await export_query_xlsx(filename, query)
+            
+            if not row_count:
+                os.remove(filename)
                 await message.answer("✅ Query executed successfully. No results.")
                 await state.clear()
                 return
             
-            if not os.path.exists('temp_files'):
-                os.makedirs('temp_files')
-            
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"temp_files/sql_result_{timestamp}.xlsx"
-            
-            df = pd.DataFrame(result)
-            df.to_excel(filename, index=False, engine='openpyxl')
-            
-            with open(filename, 'rb') as file:
-                await message.answer_document(
-                    document=types.BufferedInputFile(file.read(), filename=f"sql_result_{timestamp}.xlsx"),
-                    caption=f"📋 SQL query result: {len(result)} rows"
-                )
+            await message.answer_document(
+                document=types.FSInputFile(filename, filename=f"sql_result_{timestamp}.xlsx"),
+                caption=f"📋 SQL query result: {row_count} rows"
+            )
         else:
             result = await db.execute(query)
+            # Raw SQL may have changed roles or stock behind the cache
+            cache.clear()
             await message.answer(f"✅ Query executed successfully. Rows affected: {result}")
         
         await state.clear()
@@ -1400,61 +1813,24 @@ async def process_admin_sql(message: Message, state: FSMContext):
 # =============================================================================
 
 @dp.message(Command("help"))
+@rate_limited
 async def cmd_help(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
-    user = await db.fetchone("SELECT role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    role = await get_user_role(message.from_user.id)
     
-    if not user:
-        help_text = (
-            "🤖 <b>Tyreterra Bot Help</b>\n\n"
-            "To start working with the bot:\n"
-            "1. Use /start to register\n"
-            "2. Choose your role (Dealer/Buyer)\n"
-            "3. Fill in your details\n\n"
-            "❌ Cancel any operation: /cancel\n"
-            "🆘 Help: /help"
-        )
+    if role is None:
+        help_text = HELP_ANON
     else:
-        role = user[0]
-        
-        if role == 'Dealer':
-            help_text = (
-                "🤖 <b>Tyreterra Bot Help</b>\n\n"
-                "<b>Available commands:</b>\n"
-                "• /addstock - Add item to stock\n"
-                "• /mystock - Download your stock\n"
-                "• /search - Search in other users' stock\n"
-                "• /deletestock - Delete your entire stock\n"
-                "• /deleteitem - Delete specific item\n"
-                "• /help - This help\n\n"
-                "❌ Cancel any operation: /cancel"
-            )
-        elif role == 'Buyer':
-            help_text = (
-                "🤖 <b>Tyreterra Bot Help</b>\n\n"
-                "<b>Available commands:</b>\n"
-                "• /search - Search in other users' stock\n"
-                "• /help - This help\n\n"
-                "❌ Cancel any operation: /cancel"
-            )
-        else:
-            help_text = "Unknown role. Please contact administrator."
+        help_text = HELP_BY_ROLE.get(role, HELP_UNKNOWN_ROLE)
     
-    await message.answer(help_text, reply_markup=await get_main_keyboard(message.from_user.id))
+    await message.answer(help_text, reply_markup=main_keyboard_for(message.from_user.id, role))
 
 # =============================================================================
 # UNKNOWN COMMANDS HANDLER
 # =============================================================================
 
 @dp.message()
+@rate_limited
 async def unknown_command(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Too many requests. Please wait a bit.")
-        return
-        
     await message.answer(
         "❌ Unknown command. Use /help to see available commands.",
         reply_markup=await get_main_keyboard(message.from_user.id)
@@ -1466,19 +1842,31 @@ async def unknown_command(message: Message):
 
 async def main():
     # Initialize database
+    await db.connect()
     await db.init_db()
     
-    # Create temp directory
-    if not os.path.exists('temp_files'):
-        os.makedirs('temp_files')
+    # Create temp directory once; exports write into it without checking
+    os.makedirs('temp_files', exist_ok=True)
     
-    # Cleanup old temp files
-    cleanup_temp_files()
+    # Cleanup old temp files now and then periodically
+    cleaner = asyncio.create_task(run_temp_cleanup())
+    
+    # Periodically evict expired cache entries and idle rate-limit buckets
+    sweeper = asyncio.create_task(cache.run_sweeper())
+    pruner = asyncio.create_task(rate_limiter.run_pruner())
     
     logger.info("Bot started successfully")
     
     # Start polling
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        sweeper.cancel()
+        pruner.cancel()
+        cleaner.cancel()
+        await db.close()
+        await bot.session.close()
+        log_listener.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
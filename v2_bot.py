@@ -1,8 +1,11 @@
 import asyncio
+import functools
+import inspect
 import logging
 import sqlite3
 import os
 import time
+import io
 import re
 import shutil
 import aiosqlite
@@ -20,17 +23,22 @@ from aiogram.client.default import DefaultBotProperties
 import pandas as pd
 import aiofiles
 import openpyxl
+import xlsxwriter
 
 # =============================================================================
 # КОНФИГУРАЦИЯ
 # =============================================================================
 
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8294936286:AAGfR-q_GGWIlxS4QlOwhAsJyFtSgFKKK_I")
-ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "7975448643").split(',')))
+ADMIN_IDS = frozenset(map(int, os.getenv("ADMIN_IDS", "7975448643").split(',')))
 DB_PATH = os.getenv("DB_PATH", "tyreterra.db")
 MAX_STOCK_ITEMS = int(os.getenv("MAX_STOCK_ITEMS", "10000"))
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", "52428800"))  # 50MB
 
+# Рабочие папки создаются один раз при импорте, обработчики их уже не проверяют
+for folder in ('temp_files', 'uploads'):
+    os.makedirs(folder, exist_ok=True)
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -47,9 +55,10 @@ logger = logging.getLogger(__name__)
 # =============================================================================
 
 class Cache:
-    def __init__(self, timeout=300):
+    def __init__(self, timeout=300, max_items=None):
         self.cache = {}
         self.timeout = timeout
+        self.max_items = max_items
     
     def get(self, key):
         if key in self.cache:
@@ -61,12 +70,32 @@ class Cache:
         return None
     
     def set(self, key, data):
+        # Перезапись переносит ключ в конец, так что первым в словаре лежит самый старый
+        self.cache.pop(key, None)
+        if self.max_items is not None and len(self.cache) >= self.max_items:
+            self.purge_expired()
+            while len(self.cache) >= self.max_items:
+                del self.cache[next(iter(self.cache))]
         self.cache[key] = (data, time.time())
     
+    def delete(self, key):
+        self.cache.pop(key, None)
+    
+    def purge_expired(self):
+        """Удаляет просроченные записи, которые больше никто не запрашивал"""
+        now = time.time()
+        expired = [key for key, (_, timestamp) in self.cache.items() if now - timestamp >= self.timeout]
+        for key in expired:
+            del self.cache[key]
+    
     def clear(self):
         self.cache.clear()
 
-cache = Cache()
+# Пользователей меняют и admin_console, и другие боты, поэтому строки из users живут минуту
+user_cache = Cache(timeout=60)
+# Готовые Excel-файлы /mystock весят до мегабайт, поэтому их число ограничено
+MYSTOCK_CACHE_MAX = int(os.getenv("MYSTOCK_CACHE_MAX", "50"))
+stock_file_cache = Cache(max_items=MYSTOCK_CACHE_MAX)
 
 class RateLimiter:
     def __init__(self, max_requests=10, window=60):
@@ -108,6 +137,28 @@ def cleanup_temp_files():
 # БАЗА ДАННЫХ (АСИНХРОННАЯ)
 # =============================================================================
 
+# Повторяющиеся запросы вынесены в константы: один текст на запрос во всех обработчиках
+SQL_GET_USER_BY_TID = "SELECT id, role, company_name FROM users WHERE telegram_id = ?"
+SQL_GET_USER_ROW = "SELECT * FROM users WHERE telegram_id = ?"
+SQL_USER_STOCK_COUNT = "SELECT COUNT(*) FROM stock WHERE user_id = ?"
+SQL_MY_STOCK = """
+    SELECT sku, tyre_size, tyre_pattern, brand, country, 
+           qty_available, retail_price, wholesale_price, warehouse_location
+    FROM stock 
+    WHERE user_id = ?
+    ORDER BY date DESC
+"""
+SQL_INSERT_STOCK = """INSERT INTO stock 
+    (user_id, sku, tyre_size, tyre_pattern, brand, country, qty_available, retail_price, wholesale_price, warehouse_location) 
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+SQL_GET_STOCK_ITEM = "SELECT sku, tyre_size, brand FROM stock WHERE id = ?"
+SQL_DELETE_STOCK_ITEM = "DELETE FROM stock WHERE id = ?"
+SQL_DELETE_USER_STOCK = "DELETE FROM stock WHERE user_id = ?"
+SQL_COUNT_USERS = "SELECT COUNT(*) FROM users"
+SQL_COUNT_STOCK = "SELECT COUNT(*) FROM stock"
+SQL_COUNT_DEALERS = "SELECT COUNT(*) FROM users WHERE role = 'Дилер'"
+SQL_COUNT_BUYERS = "SELECT COUNT(*) FROM users WHERE role = 'Покупатель'"
+
 class AsyncDatabase:
     def __init__(self, db_path=DB_PATH):
         self.db_path = db_path
@@ -178,6 +229,18 @@ class AsyncDatabase:
             await conn.commit()
             return cursor.lastrowid
     
+    async def executemany(self, query, seq_of_params):
+        """Выполнить запрос для набора параметров одной транзакцией"""
+        async with aiosqlite.connect(self.db_path, timeout=30.0) as conn:
+            await conn.execute("BEGIN")
+            try:
+                cursor = await conn.executemany(query, seq_of_params)
+            except Exception:
+                await conn.rollback()
+                raise
+            await conn.commit()
+            return cursor.rowcount
+    
     async def fetchone(self, query, params=()):
         async with aiosqlite.connect(self.db_path, timeout=30.0) as conn:
             cursor = await conn.execute(query, params)
@@ -190,7 +253,7 @@ class AsyncDatabase:
     
     async def get_user_stock_count(self, user_id):
         result = await self.fetchone(
-            "SELECT COUNT(*) FROM stock WHERE user_id = ?", 
+            SQL_USER_STOCK_COUNT, 
             (user_id,)
         )
         return result[0] if result else 0
@@ -281,6 +344,7 @@ class AddStock(StatesGroup):
     waiting_for_retail_price = State()
     waiting_for_wholesale_price = State()
     waiting_for_warehouse = State()
+    waiting_for_bulk = State()
 
 class UploadExcel(StatesGroup):
     waiting_for_file = State()
@@ -323,24 +387,64 @@ class SubscriptionState(StatesGroup):
 def is_admin(telegram_id):
     return telegram_id in ADMIN_IDS
 
-async def check_rate_limit(user_id: int) -> bool:
-    if rate_limiter.is_limited(user_id):
-        return True
-    return False
+RATE_LIMIT_MSG = "⚠️ Слишком много запросов. Подождите немного."
+CANCEL_BUTTON = "❌ Отмена"
+CANCEL_COMMANDS = frozenset({'/cancel', CANCEL_BUTTON})
+CANCEL_HINT = "❌ Для отмены введите /cancel или нажмите кнопку"
+CANCEL_MSG = "❌ Операция отменена."
+PENDING_OPERATION_MSG = "⚠️ У вас есть незавершенная операция. Завершите ее или отмените командой /cancel"
+
+def check_rate_limit(user_id: int) -> bool:
+    return rate_limiter.is_limited(user_id)
+
+def rate_limited(handler):
+    """Декоратор обработчика: вместо превысившего лимит запроса отвечает RATE_LIMIT_MSG"""
+    @functools.wraps(handler)
+    async def wrapper(message: Message, *args, **kwargs):
+        if check_rate_limit(message.from_user.id):
+            await message.answer(RATE_LIMIT_MSG)
+            return
+        return await handler(message, *args, **kwargs)
+    
+    # aiogram передает kwargs по сигнатуре обработчика, поэтому отдаем ему исходную
+    wrapper.__signature__ = inspect.signature(handler)
+    return wrapper
+
+async def get_cached_user(telegram_id):
+    """(id, role, company_name) пользователя или None; результат кэшируется, чтобы обработчик и клавиатура не ходили в базу дважды"""
+    key = f"user_{telegram_id}"
+    user = user_cache.get(key)
+    if user is None:
+        row = await db.fetchone(SQL_GET_USER_BY_TID, (telegram_id,))
+        # Незарегистрированные кэшируются как (), запись сбрасывается при регистрации
+        user = tuple(row) if row else ()
+        user_cache.set(key, user)
+    return user or None
 
 async def get_user_role(telegram_id):
-    return await db.get_user_role(telegram_id)
+    user = await get_cached_user(telegram_id)
+    return user[1] if user else None
+
+# Регулярные выражения компилируются один раз при загрузке модуля
+EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+PRICE_RE = re.compile(r'^\d+(\.\d+)?$')
+SIZE_DOT_RE = re.compile(r'[\.]')
+SIZE_R_RE = re.compile(r'\s*R\s*')
+SIZE_SPACES_RE = re.compile(r'\s+')
 
 def validate_email(email):
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return EMAIL_RE.match(email) is not None
 
 def validate_inn(inn):
     return inn.isdigit() and len(inn) in [10, 12]
 
+# Таблица для удаления пробелов, дефисов и скобок за один проход
+PHONE_STRIP = str.maketrans('', '', ' -()')
+
 def validate_phone(phone):
-    phone = phone.replace('+7', '8').replace(' ', '').replace('-', '').replace('(', '').replace(')', '')
-    return phone.isdigit() and len(phone) == 11 and phone.startswith('8')
+    phone = phone.replace('+7', '8').translate(PHONE_STRIP)
+    # Дешевые проверки длины и первой цифры идут до полного прохода isdigit
+    return len(phone) == 11 and phone.startswith('8') and phone.isdigit()
 
 def normalize_tyre_size(size: str) -> str:
     """Нормализация типоразмера для поиска"""
@@ -351,12 +455,50 @@ def normalize_tyre_size(size: str) -> str:
     size = size.upper().strip()
     
     # Заменяем точки на слеши, убираем лишние пробелы вокруг R
-    size = re.sub(r'[\.]', '/', size)  # Заменяем точки на слеши
-    size = re.sub(r'\s*R\s*', 'R', size)  # Убираем пробелы вокруг R
-    size = re.sub(r'\s+', ' ', size)  # Заменяем множественные пробелы на один
+    size = SIZE_DOT_RE.sub('/', size)  # Заменяем точки на слеши
+    size = SIZE_R_RE.sub('R', size)  # Убираем пробелы вокруг R
+    size = SIZE_SPACES_RE.sub(' ', size)  # Заменяем множественные пробелы на один
     
     return size
 
+STOCK_LINE_FORMAT = "SKU|Типоразмер|Модель|Бренд|Страна|Количество|Розничная цена|Оптовая цена|Склад"
+
+# Подсказки добавления товара собираются один раз при импорте
+ADD_STOCK_PROMPT = (
+    "📦 <b>Добавление нового товара</b>\n\n"
+    "Введите артикул (SKU):\n\n"
+    f"{CANCEL_HINT}"
+)
+ADD_STOCK_BULK_PROMPT = (
+    "📦 <b>Быстрое добавление товаров</b>\n\n"
+    "Отправьте товары одним сообщением, по одному на строку, поля через '|':\n"
+    f"<code>{STOCK_LINE_FORMAT}</code>\n\n"
+    "Например:\n"
+    "<code>A123|195/65 R15|Nordman 7|Nokian|Россия|8|5200|4700|Москва\n"
+    "B456|205/55 R16|Hakka Blue|Nokian|Финляндия|4|7100|6500|Москва</code>\n\n"
+    f"{CANCEL_HINT}"
+)
+
+def parse_price(text: str) -> float:
+    """Цена из текста пользователя; ValueError если это не положительное число"""
+    price_text = text.strip().replace(',', '.').replace(' ', '')
+    if not PRICE_RE.match(price_text) or float(price_text) <= 0:
+        raise ValueError(f"некорректная цена '{text.strip()}'")
+    return float(price_text)
+
+def parse_stock_line(line: str) -> tuple:
+    """Разбор строки формата STOCK_LINE_FORMAT в параметры INSERT (без user_id)"""
+    fields = [field.strip() for field in line.split('|', 8)]
+    if len(fields) != 9:
+        raise ValueError(f"ожидается 9 полей через '|', получено {len(fields)}")
+    sku, tyre_size, tyre_pattern, brand, country, qty_text, retail_text, wholesale_text, warehouse_location = fields
+    if not sku or not tyre_size or not brand:
+        raise ValueError("SKU, типоразмер и бренд обязательны")
+    if not qty_text.isdigit() or int(qty_text) <= 0:
+        raise ValueError(f"некорректное количество '{qty_text}'")
+    return (sku, tyre_size, tyre_pattern, brand, country, int(qty_text),
+            parse_price(retail_text), parse_price(wholesale_text), warehouse_location)
+
 def size_matches(search_size: str, stock_size: str) -> bool:
     """Проверяет совпадение типоразмеров с учетом разных форматов"""
     normalized_search = normalize_tyre_size(search_size)
@@ -376,107 +518,133 @@ def size_matches(search_size: str, stock_size: str) -> bool:
 # КЛАВИАТУРЫ
 # =============================================================================
 
+# Клавиатуры не меняются, поэтому собираются один раз при загрузке модуля,
+# а функции ниже возвращают готовые объекты
+
+ROLE_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Дилер"), KeyboardButton(text="Покупатель")]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+ADMIN_MAIN_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📦 Мой склад"), KeyboardButton(text="🔍 Поиск")],
+        [KeyboardButton(text="➕ Добавить товар"), KeyboardButton(text="📤 Загрузить Excel")],
+        [KeyboardButton(text="🗑️ Удалить товар"), KeyboardButton(text="🗑️ Удалить весь склад")],
+        [KeyboardButton(text="✏️ Профиль"), KeyboardButton(text="🔔 Уведомления")],
+        [KeyboardButton(text="🛠️ Админ"), KeyboardButton(text="❓ Помощь")]
+    ],
+    resize_keyboard=True,
+    input_field_placeholder="Выберите действие..."
+)
+
+DEALER_MAIN_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📦 Мой склад"), KeyboardButton(text="🔍 Поиск")],
+        [KeyboardButton(text="➕ Добавить товар"), KeyboardButton(text="📤 Загрузить Excel")],
+        [KeyboardButton(text="🗑️ Удалить товар"), KeyboardButton(text="🗑️ Удалить весь склад")],
+        [KeyboardButton(text="✏️ Профиль"), KeyboardButton(text="🔔 Уведомления")],
+        [KeyboardButton(text="❓ Помощь")]
+    ],
+    resize_keyboard=True,
+    input_field_placeholder="Выберите действие..."
+)
+
+BUYER_MAIN_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="🔍 Поиск"), KeyboardButton(text="✏️ Профиль")],
+        [KeyboardButton(text="🔔 Уведомления"), KeyboardButton(text="❓ Помощь")]
+    ],
+    resize_keyboard=True,
+    input_field_placeholder="Выберите действие..."
+)
+
+SEARCH_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="🔍 Умный поиск"), KeyboardButton(text="📦 Все товары")],
+        [KeyboardButton(text=CANCEL_BUTTON)]
+    ],
+    resize_keyboard=True
+)
+
+SEARCH_TYPE_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="🏷️ SKU"), KeyboardButton(text="📏 Типоразмер")],
+        [KeyboardButton(text="🏭 Бренд"), KeyboardButton(text="📍 Склад")],
+        [KeyboardButton(text="🌍 Страна"), KeyboardButton(text=CANCEL_BUTTON)]
+    ],
+    resize_keyboard=True
+)
+
+SUBSCRIPTION_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="🏭 Бренд"), KeyboardButton(text="📏 Типоразмер")],
+        [KeyboardButton(text="🏢 Дилер"), KeyboardButton(text="📋 Мои подписки")],
+        [KeyboardButton(text=CANCEL_BUTTON)]
+    ],
+    resize_keyboard=True
+)
+
+CONFIRM_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="✅ Да"), KeyboardButton(text="❌ Нет")]
+    ],
+    resize_keyboard=True
+)
+
+ADMIN_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="👥 Пользователи"), KeyboardButton(text="📊 Статистика")],
+        [KeyboardButton(text="💾 Экспорт"), KeyboardButton(text="🔄 Бэкап")],
+        [KeyboardButton(text="🗃️ SQL"), KeyboardButton(text="⚙️ Настройки")],
+        [KeyboardButton(text="🏠 Главное меню")]
+    ],
+    resize_keyboard=True
+)
+
+CANCEL_KB = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text=CANCEL_BUTTON)]],
+    resize_keyboard=True
+)
+
 def get_role_keyboard():
     """Клавиатура выбора роли при регистрации"""
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Дилер"), KeyboardButton(text="Покупатель")]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
+    return ROLE_KB
 
 def get_main_menu_keyboard(telegram_id: int, is_admin: bool = False, role: str = "Покупатель"):
     """Основное меню с кнопками"""
-    buttons = []
-    
     if is_admin:
-        buttons = [
-            [KeyboardButton(text="📦 Мой склад"), KeyboardButton(text="🔍 Поиск")],
-            [KeyboardButton(text="➕ Добавить товар"), KeyboardButton(text="📤 Загрузить Excel")],
-            [KeyboardButton(text="🗑️ Удалить товар"), KeyboardButton(text="🗑️ Удалить весь склад")],
-            [KeyboardButton(text="✏️ Профиль"), KeyboardButton(text="🔔 Уведомления")],
-            [KeyboardButton(text="🛠️ Админ"), KeyboardButton(text="❓ Помощь")]
-        ]
-    elif role == "Дилер":
-        buttons = [
-            [KeyboardButton(text="📦 Мой склад"), KeyboardButton(text="🔍 Поиск")],
-            [KeyboardButton(text="➕ Добавить товар"), KeyboardButton(text="📤 Загрузить Excel")],
-            [KeyboardButton(text="🗑️ Удалить товар"), KeyboardButton(text="🗑️ Удалить весь склад")],
-            [KeyboardButton(text="✏️ Профиль"), KeyboardButton(text="🔔 Уведомления")],
-            [KeyboardButton(text="❓ Помощь")]
-        ]
-    else:  # Покупатель
-        buttons = [
-            [KeyboardButton(text="🔍 Поиск"), KeyboardButton(text="✏️ Профиль")],
-            [KeyboardButton(text="🔔 Уведомления"), KeyboardButton(text="❓ Помощь")]
-        ]
-    
-    return ReplyKeyboardMarkup(
-        keyboard=buttons,
-        resize_keyboard=True,
-        input_field_placeholder="Выберите действие..."
-    )
+        return ADMIN_MAIN_KB
+    if role == "Дилер":
+        return DEALER_MAIN_KB
+    return BUYER_MAIN_KB
 
 def get_search_keyboard():
     """Клавиатура выбора типа поиска"""
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🔍 Умный поиск"), KeyboardButton(text="📦 Все товары")],
-            [KeyboardButton(text="❌ Отмена")]
-        ],
-        resize_keyboard=True
-    )
+    return SEARCH_KB
 
 def get_search_type_keyboard():
     """Клавиатура выбора параметра поиска"""
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🏷️ SKU"), KeyboardButton(text="📏 Типоразмер")],
-            [KeyboardButton(text="🏭 Бренд"), KeyboardButton(text="📍 Склад")],
-            [KeyboardButton(text="🌍 Страна"), KeyboardButton(text="❌ Отмена")]
-        ],
-        resize_keyboard=True
-    )
+    return SEARCH_TYPE_KB
 
 def get_subscription_keyboard():
     """Клавиатура управления подписками"""
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🏭 Бренд"), KeyboardButton(text="📏 Типоразмер")],
-            [KeyboardButton(text="🏢 Дилер"), KeyboardButton(text="📋 Мои подписки")],
-            [KeyboardButton(text="❌ Отмена")]
-        ],
-        resize_keyboard=True
-    )
+    return SUBSCRIPTION_KB
 
 def get_confirmation_keyboard():
     """Клавиатура подтверждения действий"""
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="✅ Да"), KeyboardButton(text="❌ Нет")]
-        ],
-        resize_keyboard=True
-    )
+    return CONFIRM_KB
 
 def get_admin_keyboard():
     """Клавиатура админ-панели"""
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="👥 Пользователи"), KeyboardButton(text="📊 Статистика")],
-            [KeyboardButton(text="💾 Экспорт"), KeyboardButton(text="🔄 Бэкап")],
-            [KeyboardButton(text="🗃️ SQL"), KeyboardButton(text="⚙️ Настройки")],
-            [KeyboardButton(text="🏠 Главное меню")]
-        ],
-        resize_keyboard=True
-    )
+    return ADMIN_KB
 
 def get_cancel_keyboard():
     """Простая клавиатура с кнопкой отмены"""
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="❌ Отмена")]],
-        resize_keyboard=True
-    )
+    return CANCEL_KB
 
 def get_delete_selection_keyboard(suggestions):
     """Клавиатура для выбора товара для удаления"""
@@ -488,40 +656,53 @@ def get_delete_selection_keyboard(suggestions):
             button_text = button_text[:47] + "..."
         keyboard.append([KeyboardButton(text=button_text)])
     
-    keyboard.append([KeyboardButton(text="❌ Отмена")])
+    keyboard.append([KeyboardButton(text=CANCEL_BUTTON)])
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
+def build_xlsx(columns, rows) -> bytes:
+    """Пишет заголовок и строки в xlsx в памяти (блокирующая, вызывать через to_thread)"""
+    buf = io.BytesIO()
+    # Строки из базы пишутся как есть, без промежуточного DataFrame
+    wb = xlsxwriter.Workbook(buf, {'in_memory': True, 'strings_to_numbers': False})
+    ws = wb.add_worksheet()
+    ws.write_row(0, 0, columns)
+    for row_num, row in enumerate(rows, 1):
+        ws.write_row(row_num, 0, row)
+    wb.close()
+    return buf.getvalue()
+
+# Колонки выгрузки поиска и список SELECT для них, ключ - покупатель ли пользователь.
+# Для покупателей оптовая цена и контакты других пользователей не выбираются вовсе
+SEARCH_PROJECTIONS = {
+    False: (
+        ['sku', 'tyre_size', 'tyre_pattern', 'brand', 'country', 
+         'qty_available', 'retail_price', 'wholesale_price', 'warehouse_location',
+         'company_name', 'phone', 'email'],
+        """s.sku, s.tyre_size, s.tyre_pattern, s.brand, s.country, 
+           s.qty_available, s.retail_price, s.wholesale_price, 
+           s.warehouse_location, u.company_name, u.phone, u.email"""
+    ),
+    True: (
+        ['sku', 'tyre_size', 'tyre_pattern', 'brand', 'country', 
+         'qty_available', 'retail_price', 'warehouse_location', 'company_name'],
+        """s.sku, s.tyre_size, s.tyre_pattern, s.brand, s.country, 
+           s.qty_available, s.retail_price, 
+           s.warehouse_location, u.company_name"""
+    ),
+}
+
+def search_projection(user_role):
+    """(колонки, список SELECT) для выгрузки поиска с учетом роли"""
+    return SEARCH_PROJECTIONS[user_role == 'Покупатель']
+
 async def create_search_excel(stock_items, user_role, search_type="результаты"):
-    """Создает Excel файл с результатами поиска (скрывает оптовую цену для покупателей)"""
+    """Собирает Excel с результатами поиска в памяти; строки уже выбраны через search_projection"""
     if not stock_items:
         return None
     
-    if not os.path.exists('temp_files'):
-        os.makedirs('temp_files')
-    
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"temp_files/search_{timestamp}.xlsx"
-    
-    # Для покупателей скрываем оптовую цену и контакты других пользователей
-    if user_role == 'Покупатель':
-        columns = ['sku', 'tyre_size', 'tyre_pattern', 'brand', 'country', 
-                  'qty_available', 'retail_price', 'warehouse_location', 'company_name']
-        
-        processed_items = []
-        for item in stock_items:
-            processed_item = list(item[:6]) + [item[6]] + [item[8]] + [item[9]]  # Пропускаем wholesale_price и контакты
-            processed_items.append(processed_item)
-        
-        df = pd.DataFrame(processed_items, columns=columns)
-    else:
-        # Для дилеров и админов показываем все данные
-        columns = ['sku', 'tyre_size', 'tyre_pattern', 'brand', 'country', 
-                  'qty_available', 'retail_price', 'wholesale_price', 'warehouse_location',
-                  'company_name', 'phone', 'email']
-        df = pd.DataFrame(stock_items, columns=columns)
-    
-    df.to_excel(filename, index=False, engine='openpyxl')
-    return filename
+    columns, _ = search_projection(user_role)
+    # Файл нужен только для отправки, поэтому на диск его не пишем
+    return await asyncio.to_thread(build_xlsx, columns, stock_items)
 
 async def send_notifications(sub_type: str, sub_value: str, message: str):
     """Отправка уведомлений подписчикам"""
@@ -540,12 +721,9 @@ async def send_notifications(sub_type: str, sub_value: str, message: str):
 # =============================================================================
 
 @dp.message(F.text == "📤 Загрузить Excel")
+@rate_limited
 async def cmd_upload_excel(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    user = await db.fetchone("SELECT id, role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_cached_user(message.from_user.id)
     
     if not user:
         await message.answer("Сначала зарегистрируйтесь с помощью /start")
@@ -575,12 +753,9 @@ async def cmd_upload_excel(message: Message, state: FSMContext):
 
 @dp.message(UploadExcel.waiting_for_file)
 @dp.message(F.document)
+@rate_limited
 async def process_excel_upload(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
     
@@ -608,10 +783,6 @@ async def process_excel_upload(message: Message, state: FSMContext):
         file = await bot.get_file(file_id)
         file_path = file.file_path
         
-        # Создаем папку для загрузок если нет
-        if not os.path.exists('uploads'):
-            os.makedirs('uploads')
-        
         # Сохраняем файл
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         local_filename = f"uploads/{message.from_user.id}_{timestamp}_{file_name}"
@@ -628,12 +799,12 @@ async def process_excel_upload(message: Message, state: FSMContext):
 async def process_excel_file(message: Message, file_path: str, state: FSMContext):
     """Обработка Excel файла и добавление товаров в базу"""
     try:
-        user = await db.fetchone("SELECT id, company_name FROM users WHERE telegram_id = ?", (message.from_user.id,))
+        user = await get_cached_user(message.from_user.id)
         if not user:
             await message.answer("❌ Ошибка: пользователь не найден")
             return
         
-        user_id, company_name = user[0], user[1]
+        user_id, company_name = user[0], user[2]
         
         # Читаем Excel файл
         df = pd.read_excel(file_path)
@@ -670,6 +841,9 @@ async def process_excel_file(message: Message, file_path: str, state: FSMContext
         success_count = 0
         error_count = 0
         errors = []
+        # Строки копятся и вставляются одной транзакцией после разбора файла
+        stock_rows = []
+        free_slots = MAX_STOCK_ITEMS - await db.get_user_stock_count(user_id)
         
         for index, row in df.iterrows():
             try:
@@ -755,27 +929,26 @@ async def process_excel_file(message: Message, file_path: str, state: FSMContext
                         warehouse_location = str(warehouse_value).strip()
                 
                 # Проверяем лимит товаров
-                current_stock_count = await db.get_user_stock_count(user_id)
-                if current_stock_count >= MAX_STOCK_ITEMS:
+                if len(stock_rows) >= free_slots:
                     errors.append(f"Достигнут лимит товаров ({MAX_STOCK_ITEMS}). Прерываю загрузку.")
                     break
                 
-                # Добавляем товар в базу
-                await db.execute(
-                    """INSERT INTO stock 
-                    (user_id, sku, tyre_size, tyre_pattern, brand, country, qty_available, retail_price, wholesale_price, warehouse_location) 
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                stock_rows.append(
                     (user_id, sku, tyre_size, tyre_pattern, brand, country, qty_available, retail_price, wholesale_price, warehouse_location)
                 )
                 
-                success_count += 1
-                
             except Exception as e:
                 error_count += 1
                 errors.append(f"Строка {index+2}: {str(e)}")
                 logger.error(f"Error processing row {index+2}: {e}")
                 continue
         
+        # Добавляем товары в базу
+        if stock_rows:
+            await db.executemany(SQL_INSERT_STOCK, stock_rows)
+            success_count = len(stock_rows)
+            stock_file_cache.delete(f"mystock_{user_id}")
+        
         # Формируем отчет
         report_text = f"📊 <b>Отчет о загрузке</b>\n\n"
         report_text += f"✅ Успешно загружено: {success_count} товаров\n"
@@ -857,12 +1030,9 @@ async def process_excel_file(message: Message, file_path: str, state: FSMContext
 # =============================================================================
 
 @dp.message(Command("cancel"))
-@dp.message(F.text == "❌ Отмена")
+@dp.message(F.text == CANCEL_BUTTON)
+@rate_limited
 async def cancel_handler(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     current_state = await state.get_state()
     if current_state is None:
         await message.answer("Нет активных операций для отмены.")
@@ -872,21 +1042,18 @@ async def cancel_handler(message: Message, state: FSMContext):
     user_role = await get_user_role(message.from_user.id)
     is_admin_user = is_admin(message.from_user.id)
     await message.answer(
-        "❌ Операция отменена.", 
+        CANCEL_MSG, 
         reply_markup=get_main_menu_keyboard(message.from_user.id, is_admin_user, user_role)
     )
 
 @dp.message(Command("start"))
 @dp.message(F.text == "🏠 Главное меню")
+@rate_limited
 async def cmd_start(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     user_id = message.from_user.id
     user_name = message.from_user.full_name
     
-    user = await db.fetchone("SELECT * FROM users WHERE telegram_id = ?", (user_id,))
+    user = await db.fetchone(SQL_GET_USER_ROW, (user_id,))
     
     if not user:
         await message.answer(
@@ -908,11 +1075,8 @@ async def cmd_start(message: Message, state: FSMContext):
 
 @dp.message(F.text == "❓ Помощь")
 @dp.message(Command("help"))
+@rate_limited
 async def cmd_help(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     user_role = await get_user_role(message.from_user.id)
     is_admin_user = is_admin(message.from_user.id)
     
@@ -970,12 +1134,9 @@ async def cmd_help(message: Message):
 
 @dp.message(F.text == "✏️ Профиль")
 @dp.message(Command("profile"))
+@rate_limited
 async def cmd_profile(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    user = await db.fetchone("SELECT * FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await db.fetchone(SQL_GET_USER_ROW, (message.from_user.id,))
     
     if not user:
         await message.answer("Сначала зарегистрируйтесь с помощью /start")
@@ -1002,12 +1163,9 @@ async def cmd_profile(message: Message):
 
 @dp.message(F.text == "📦 Мой склад")
 @dp.message(Command("mystock"))
+@rate_limited
 async def cmd_my_stock(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    user = await db.fetchone("SELECT id, role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_cached_user(message.from_user.id)
     
     if not user:
         await message.answer("Сначала зарегистрируйтесь с помощью /start")
@@ -1015,41 +1173,44 @@ async def cmd_my_stock(message: Message):
     
     user_id, user_role = user[0], user[1]
     
+    # Готовый файл берем из кэша: он сбрасывается при добавлении и удалении товаров
+    cache_key = f"mystock_{user_id}"
+    cached = stock_file_cache.get(cache_key)
+    if cached:
+        xlsx_data, stock_count = cached
+        await message.answer_document(
+            document=types.BufferedInputFile(
+                xlsx_data, 
+                filename=f"мой_склад_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+            ),
+            caption=f"📦 Ваш склад ({stock_count} товаров) [КЭШ]"
+        )
+        return
+    
     try:
         # Получаем товары пользователя
-        stock_items = await db.fetchall("""
-            SELECT sku, tyre_size, tyre_pattern, brand, country, 
-                   qty_available, retail_price, wholesale_price, warehouse_location
-            FROM stock 
-            WHERE user_id = ?
-            ORDER BY date DESC
-        """, (user_id,))
+        stock_items = await db.fetchall(SQL_MY_STOCK, (user_id,))
         
         if not stock_items:
             await message.answer("📭 Ваш склад пуст.")
             return
         
-        # Создаем Excel файл
-        if not os.path.exists('temp_files'):
-            os.makedirs('temp_files')
-        
+        # Создаем Excel файл в памяти, без записи во временную папку
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"temp_files/my_stock_{timestamp}.xlsx"
         
         columns = ['SKU', 'Типоразмер', 'Модель', 'Бренд', 'Страна', 
                   'Количество', 'Розничная цена', 'Оптовая цена', 'Склад']
         
-        df = pd.DataFrame(stock_items, columns=columns)
-        df.to_excel(filename, index=False, engine='openpyxl')
+        xlsx_data = await asyncio.to_thread(build_xlsx, columns, stock_items)
+        stock_file_cache.set(cache_key, (xlsx_data, len(stock_items)))
         
-        with open(filename, 'rb') as file:
-            await message.answer_document(
-                document=types.BufferedInputFile(
-                    file.read(), 
-                    filename=f"мой_склад_{timestamp}.xlsx"
-                ),
-                caption=f"📦 Ваш склад ({len(stock_items)} товаров)"
-            )
+        await message.answer_document(
+            document=types.BufferedInputFile(
+                xlsx_data, 
+                filename=f"мой_склад_{timestamp}.xlsx"
+            ),
+            caption=f"📦 Ваш склад ({len(stock_items)} товаров)"
+        )
             
     except Exception as e:
         logger.error(f"My stock export error: {e}")
@@ -1061,12 +1222,9 @@ async def cmd_my_stock(message: Message):
 
 @dp.message(F.text == "🔍 Поиск")
 @dp.message(Command("search"))
+@rate_limited
 async def cmd_search(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    user = await db.fetchone("SELECT role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_cached_user(message.from_user.id)
     
     if not user:
         await message.answer("Сначала зарегистрируйтесь с помощью /start")
@@ -1081,17 +1239,14 @@ async def cmd_search(message: Message, state: FSMContext):
     await state.set_state(SearchStock.waiting_for_search_value)
 
 @dp.message(SearchStock.waiting_for_search_value)
+@rate_limited
 async def process_smart_search(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
     
     search_term = message.text.strip()
-    user = await db.fetchone("SELECT id, role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_cached_user(message.from_user.id)
     
     if not user:
         await message.answer("❌ Ошибка: пользователь не найден")
@@ -1101,12 +1256,11 @@ async def process_smart_search(message: Message, state: FSMContext):
     
     try:
         # Поиск товаров для текущего пользователя (если дилер) или всех товаров (если покупатель)
+        _, select_list = search_projection(user_role)
         if user_role == 'Дилер' or is_admin(message.from_user.id):
             # Дилер ищет только свои товары
-            query = """
-                SELECT s.sku, s.tyre_size, s.tyre_pattern, s.brand, s.country, 
-                       s.qty_available, s.retail_price, s.wholesale_price, 
-                       s.warehouse_location, u.company_name, u.phone, u.email
+            query = f"""
+                SELECT {select_list}
                 FROM stock s 
                 JOIN users u ON s.user_id = u.id 
                 WHERE s.user_id = ? AND (
@@ -1117,10 +1271,8 @@ async def process_smart_search(message: Message, state: FSMContext):
             params = (user_id, f'%{search_term}%', f'%{search_term}%', f'%{search_term}%', f'%{search_term}%')
         else:
             # Покупатель ищет все товары
-            query = """
-                SELECT s.sku, s.tyre_size, s.tyre_pattern, s.brand, s.country, 
-                       s.qty_available, s.retail_price, s.wholesale_price, 
-                       s.warehouse_location, u.company_name, u.phone, u.email
+            query = f"""
+                SELECT {select_list}
                 FROM stock s 
                 JOIN users u ON s.user_id = u.id 
                 WHERE s.sku LIKE ? OR s.tyre_size LIKE ? OR s.tyre_pattern LIKE ? OR s.brand LIKE ?
@@ -1138,18 +1290,17 @@ async def process_smart_search(message: Message, state: FSMContext):
             await state.clear()
             return
         
-        filename = await create_search_excel(stock_items, user_role, "smart_search")
+        xlsx_data = await create_search_excel(stock_items, user_role, "smart_search")
         
-        if filename:
-            with open(filename, 'rb') as file:
-                caption = f"🔍 Результаты поиска по '{search_term}' ({len(stock_items)} товаров)"
-                if user_role == 'Покупатель':
-                    caption += "\n👀 Показаны только розничные цены"
+        if xlsx_data:
+            caption = f"🔍 Результаты поиска по '{search_term}' ({len(stock_items)} товаров)"
+            if user_role == 'Покупатель':
+                caption += "\n👀 Показаны только розничные цены"
                 
-                await message.answer_document(
-                    document=types.BufferedInputFile(file.read(), filename=f"поиск_{search_term}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"),
-                    caption=caption
-                )
+            await message.answer_document(
+                document=types.BufferedInputFile(xlsx_data, filename=f"поиск_{search_term}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"),
+                caption=caption
+            )
         
     except Exception as e:
         logger.error(f"Smart search error: {e}")
@@ -1163,12 +1314,9 @@ async def process_smart_search(message: Message, state: FSMContext):
     )
 
 @dp.message(SearchStock.waiting_for_search_type)
+@rate_limited
 async def process_search_type(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == "❌ Отмена":
+    if message.text == CANCEL_BUTTON:
         await cancel_handler(message, state)
         return
         
@@ -1202,10 +1350,9 @@ async def execute_all_stock_search(message: Message, state: FSMContext):
         await message.answer("⏳ Формирую выгрузку всех товаров...")
         
         # Получаем ВСЕ товары ВСЕХ дилеров
-        query = """
-            SELECT s.sku, s.tyre_size, s.tyre_pattern, s.brand, s.country, 
-                   s.qty_available, s.retail_price, s.wholesale_price, 
-                   s.warehouse_location, u.company_name, u.phone, u.email
+        _, select_list = search_projection(user_role)
+        query = f"""
+            SELECT {select_list}
             FROM stock s 
             JOIN users u ON s.user_id = u.id 
             ORDER BY s.date DESC
@@ -1221,23 +1368,22 @@ async def execute_all_stock_search(message: Message, state: FSMContext):
             await state.clear()
             return
         
-        filename = await create_search_excel(stock_items, user_role, "all_stock")
+        xlsx_data = await create_search_excel(stock_items, user_role, "all_stock")
         
-        if filename:
-            with open(filename, 'rb') as file:
-                caption = f"📦 Все товары системы ({len(stock_items)} товаров)"
-                if user_role == 'Покупатель':
-                    caption += "\n👀 Показаны только розничные цены"
-                else:
-                    caption += "\n💰 Показаны розничные и оптовые цены"
+        if xlsx_data:
+            caption = f"📦 Все товары системы ({len(stock_items)} товаров)"
+            if user_role == 'Покупатель':
+                caption += "\n👀 Показаны только розничные цены"
+            else:
+                caption += "\n💰 Показаны розничные и оптовые цены"
                 
-                await message.answer_document(
-                    document=types.BufferedInputFile(
-                        file.read(), 
-                        filename=f"все_товары_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-                    ),
-                    caption=caption
-                )
+            await message.answer_document(
+                document=types.BufferedInputFile(
+                    xlsx_data, 
+                    filename=f"все_товары_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+                ),
+                caption=caption
+            )
         
     except Exception as e:
         logger.error(f"All stock search error: {e}")
@@ -1251,12 +1397,9 @@ async def execute_all_stock_search(message: Message, state: FSMContext):
     )
 
 @dp.message(SearchStock.waiting_for_search_type)
+@rate_limited
 async def process_search_type(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == "❌ Отмена":
+    if message.text == CANCEL_BUTTON:
         await cancel_handler(message, state)
         return
         
@@ -1290,10 +1433,9 @@ async def execute_all_stock_search(message: Message, state: FSMContext):
         await message.answer("⏳ Формирую выгрузку всех товаров...")
         
         # Получаем ВСЕ товары ВСЕХ дилеров
-        query = """
-            SELECT s.sku, s.tyre_size, s.tyre_pattern, s.brand, s.country, 
-                   s.qty_available, s.retail_price, s.wholesale_price, 
-                   s.warehouse_location, u.company_name, u.phone, u.email
+        _, select_list = search_projection(user_role)
+        query = f"""
+            SELECT {select_list}
             FROM stock s 
             JOIN users u ON s.user_id = u.id 
             ORDER BY s.date DESC
@@ -1309,23 +1451,22 @@ async def execute_all_stock_search(message: Message, state: FSMContext):
             await state.clear()
             return
         
-        filename = await create_search_excel(stock_items, user_role, "all_stock")
+        xlsx_data = await create_search_excel(stock_items, user_role, "all_stock")
         
-        if filename:
-            with open(filename, 'rb') as file:
-                caption = f"📦 Все товары системы ({len(stock_items)} товаров)"
-                if user_role == 'Покупатель':
-                    caption += "\n👀 Показаны только розничные цены"
-                else:
-                    caption += "\n💰 Показаны розничные и оптовые цены"
+        if xlsx_data:
+            caption = f"📦 Все товары системы ({len(stock_items)} товаров)"
+            if user_role == 'Покупатель':
+                caption += "\n👀 Показаны только розничные цены"
+            else:
+                caption += "\n💰 Показаны розничные и оптовые цены"
                 
-                await message.answer_document(
-                    document=types.BufferedInputFile(
-                        file.read(), 
-                        filename=f"все_товары_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-                    ),
-                    caption=caption
-                )
+            await message.answer_document(
+                document=types.BufferedInputFile(
+                    xlsx_data, 
+                    filename=f"все_товары_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+                ),
+                caption=caption
+            )
         
     except Exception as e:
         logger.error(f"All stock search error: {e}")
@@ -1343,12 +1484,9 @@ async def execute_all_stock_search(message: Message, state: FSMContext):
 # =============================================================================
 
 @dp.message(F.text == "🗑️ Удалить товар")
+@rate_limited
 async def cmd_delete_item(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    user = await db.fetchone("SELECT id, role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_cached_user(message.from_user.id)
     
     if not user:
         await message.answer("Сначала зарегистрируйтесь с помощью /start")
@@ -1364,27 +1502,23 @@ async def cmd_delete_item(message: Message, state: FSMContext):
         "💡 <i>Система найдет товары по любому из этих параметров</i>",
         reply_markup=get_cancel_keyboard()
     )
+    await state.update_data(user_id=user[0])
     await state.set_state(DeleteItem.waiting_for_search_term)
 
 @dp.message(DeleteItem.waiting_for_search_term)
+@rate_limited
 async def process_delete_search(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
     
     search_term = message.text.strip()
-    user = await db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user_id = (await state.get_data()).get('user_id')
     
-    if not user:
+    if not user_id:
         await message.answer("❌ Ошибка: пользователь не найден")
         return
     
-    user_id = user[0]
-    
     try:
         # Ищем товары для удаления
         suggestions = await db.search_stock_suggestions(user_id, search_term)
@@ -1419,12 +1553,9 @@ async def process_delete_search(message: Message, state: FSMContext):
         await state.clear()
 
 @dp.message(DeleteItem.waiting_for_selection)
+@rate_limited
 async def process_delete_selection(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '❌ Отмена':
+    if message.text == CANCEL_BUTTON:
         await cancel_handler(message, state)
         return
     
@@ -1471,11 +1602,8 @@ async def show_delete_confirmation(message: Message, state: FSMContext, item):
     await state.set_state(DeleteItem.confirmation)
 
 @dp.message(DeleteItem.confirmation)
+@rate_limited
 async def process_delete_confirmation(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     if message.text not in ['✅ Да', '❌ Нет']:
         await message.answer("❌ Пожалуйста, выберите '✅ Да' или '❌ Нет':")
         return
@@ -1497,13 +1625,12 @@ async def process_delete_confirmation(message: Message, state: FSMContext):
     
     try:
         # Получаем информацию о товаре перед удалением (для логов)
-        item_info = await db.fetchone(
-            "SELECT sku, tyre_size, brand FROM stock WHERE id = ?", 
-            (item_id,)
-        )
+        item_info = await db.fetchone(SQL_GET_STOCK_ITEM, (item_id,))
         
         # Удаляем товар
-        await db.execute("DELETE FROM stock WHERE id = ?", (item_id,))
+        await db.execute(SQL_DELETE_STOCK_ITEM, (item_id,))
+        # Товары для удаления ищутся только среди своих, так что владелец - user_id из состояния
+        stock_file_cache.delete(f"mystock_{user_data.get('user_id')}")
         
         if item_info:
             sku, size, brand = item_info
@@ -1533,12 +1660,9 @@ async def process_delete_confirmation(message: Message, state: FSMContext):
 # =============================================================================
 
 @dp.message(F.text == "🗑️ Удалить весь склад")
+@rate_limited
 async def cmd_delete_all_stock(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    user = await db.fetchone("SELECT id, role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_cached_user(message.from_user.id)
     
     if not user:
         await message.answer("Сначала зарегистрируйтесь с помощью /start")
@@ -1563,14 +1687,12 @@ async def cmd_delete_all_stock(message: Message, state: FSMContext):
         f"Вы уверены что хотите продолжить?",
         reply_markup=get_confirmation_keyboard()
     )
+    await state.update_data(user_id=user[0])
     await state.set_state(DeleteAllStock.confirmation)
 
 @dp.message(DeleteAllStock.confirmation)
+@rate_limited
 async def process_delete_all_confirmation(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     if message.text not in ['✅ Да', '❌ Нет']:
         await message.answer("❌ Пожалуйста, выберите '✅ Да' или '❌ Нет':")
         return
@@ -1587,14 +1709,15 @@ async def process_delete_all_confirmation(message: Message, state: FSMContext):
         return
     
     # Подтверждено удаление всего склада
-    user = await db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user_id = (await state.get_data()).get('user_id')
     
     try:
         # Получаем количество перед удалением
-        stock_count = await db.get_user_stock_count(user[0])
+        stock_count = await db.get_user_stock_count(user_id)
         
         # Удаляем все товары пользователя
-        await db.execute("DELETE FROM stock WHERE user_id = ?", (user[0],))
+        await db.execute(SQL_DELETE_USER_STOCK, (user_id,))
+        stock_file_cache.delete(f"mystock_{user_id}")
         
         await message.answer(f"✅ Весь склад успешно очищен! Удалено {stock_count} товаров.")
         
@@ -1616,12 +1739,9 @@ async def process_delete_all_confirmation(message: Message, state: FSMContext):
 
 @dp.message(F.text == "🔔 Уведомления")
 @dp.message(Command("subscriptions"))
+@rate_limited
 async def cmd_subscriptions(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    user = await db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_cached_user(message.from_user.id)
     
     if not user:
         await message.answer("Сначала зарегистрируйтесь с помощью /start")
@@ -1640,16 +1760,13 @@ async def cmd_subscriptions(message: Message, state: FSMContext):
     await state.set_state(SubscriptionState.waiting_for_type)
 
 @dp.message(SubscriptionState.waiting_for_type)
+@rate_limited
 async def process_subscription_type(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     if message.text == "📋 Мои подписки":
         await show_user_subscriptions(message, state)
         return
         
-    if message.text == "❌ Отмена":
+    if message.text == CANCEL_BUTTON:
         await cancel_handler(message, state)
         return
     
@@ -1678,12 +1795,9 @@ async def process_subscription_type(message: Message, state: FSMContext):
     await state.set_state(SubscriptionState.waiting_for_value)
 
 @dp.message(SubscriptionState.waiting_for_value)
+@rate_limited
 async def process_subscription_value(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
     
@@ -1694,7 +1808,7 @@ async def process_subscription_value_internal(message: Message, state: FSMContex
     user_data = await state.get_data()
     sub_type = user_data['subscription_type']
     
-    user = await db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_cached_user(message.from_user.id)
     user_id = user[0]
     
     # Проверяем, нет ли уже такой подписки
@@ -1725,7 +1839,7 @@ async def process_subscription_value_internal(message: Message, state: FSMContex
 
 async def show_user_subscriptions(message: Message, state: FSMContext):
     """Показать текущие подписки пользователя с кнопками удаления"""
-    user = await db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_cached_user(message.from_user.id)
     user_id = user[0]
     
     subscriptions = await db.get_user_subscriptions(user_id)
@@ -1771,7 +1885,7 @@ async def process_unsubscribe(callback: types.CallbackQuery):
     """Обработка отписки"""
     if callback.data == "unsub_all":
         # Отписка от всех уведомлений
-        user = await db.fetchone("SELECT id FROM users WHERE telegram_id = ?", (callback.from_user.id,))
+        user = await get_cached_user(callback.from_user.id)
         if user:
             user_id = user[0]
             await db.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
@@ -1810,12 +1924,9 @@ async def process_unsubscribe(callback: types.CallbackQuery):
 
 @dp.message(F.text == "➕ Добавить товар")
 @dp.message(Command("addstock"))
+@rate_limited
 async def cmd_addstock(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    user = await db.fetchone("SELECT id, role FROM users WHERE telegram_id = ?", (message.from_user.id,))
+    user = await get_cached_user(message.from_user.id)
     
     if not user:
         await message.answer("Сначала зарегистрируйтесь с помощью /start")
@@ -1832,24 +1943,18 @@ async def cmd_addstock(message: Message, state: FSMContext):
     
     current_state = await state.get_state()
     if current_state:
-        await message.answer("⚠️ У вас есть незавершенная операция. Завершите ее или отмените командой /cancel")
+        await message.answer(PENDING_OPERATION_MSG)
         return
         
-    await message.answer(
-        "📦 <b>Добавление нового товара</b>\n\n"
-        "Введите артикул (SKU):\n\n"
-        "❌ Для отмены введите /cancel или нажмите кнопку",
-        reply_markup=get_cancel_keyboard()
-    )
+    # id и компания нужны на последнем шаге, повторно в users за ними не ходим
+    await state.update_data(user_id=user[0], company_name=user[2])
+    await message.answer(ADD_STOCK_PROMPT, reply_markup=get_cancel_keyboard())
     await state.set_state(AddStock.waiting_for_sku)
 
 @dp.message(AddStock.waiting_for_sku)
+@rate_limited
 async def process_sku(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
         
@@ -1861,12 +1966,9 @@ async def process_sku(message: Message, state: FSMContext):
     await state.set_state(AddStock.waiting_for_size)
 
 @dp.message(AddStock.waiting_for_size)
+@rate_limited
 async def process_size(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
         
@@ -1878,12 +1980,9 @@ async def process_size(message: Message, state: FSMContext):
     await state.set_state(AddStock.waiting_for_pattern)
 
 @dp.message(AddStock.waiting_for_pattern)
+@rate_limited
 async def process_pattern(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
         
@@ -1895,12 +1994,9 @@ async def process_pattern(message: Message, state: FSMContext):
     await state.set_state(AddStock.waiting_for_brand)
 
 @dp.message(AddStock.waiting_for_brand)
+@rate_limited
 async def process_brand(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
         
@@ -1912,12 +2008,9 @@ async def process_brand(message: Message, state: FSMContext):
     await state.set_state(AddStock.waiting_for_country)
 
 @dp.message(AddStock.waiting_for_country)
+@rate_limited
 async def process_country(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
         
@@ -1929,12 +2022,9 @@ async def process_country(message: Message, state: FSMContext):
     await state.set_state(AddStock.waiting_for_qty)
 
 @dp.message(AddStock.waiting_for_qty)
+@rate_limited
 async def process_qty(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
         
@@ -1960,19 +2050,16 @@ async def process_qty(message: Message, state: FSMContext):
         await message.answer("❌ Пожалуйста, введите корректное число для количества:")
 
 @dp.message(AddStock.waiting_for_retail_price)
+@rate_limited
 async def process_retail_price(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
         
     try:
         # Заменяем запятые на точки и убираем пробелы
         price_text = message.text.strip().replace(',', '.').replace(' ', '')
-        if not re.match(r'^\d+(\.\d+)?$', price_text):
+        if not PRICE_RE.match(price_text):
             await message.answer("❌ Цена должна быть числом. Попробуйте снова:")
             return
             
@@ -1991,19 +2078,16 @@ async def process_retail_price(message: Message, state: FSMContext):
         await message.answer("❌ Пожалуйста, введите корректное число для цены:")
 
 @dp.message(AddStock.waiting_for_wholesale_price)
+@rate_limited
 async def process_wholesale_price(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
         
     try:
         # Заменяем запятые на точки и убираем пробелы
         price_text = message.text.strip().replace(',', '.').replace(' ', '')
-        if not re.match(r'^\d+(\.\d+)?$', price_text):
+        if not PRICE_RE.match(price_text):
             await message.answer("❌ Цена должна быть числом. Попробуйте снова:")
             return
             
@@ -2022,12 +2106,9 @@ async def process_wholesale_price(message: Message, state: FSMContext):
         await message.answer("❌ Пожалуйста, введите корректное число для цены:")
 
 @dp.message(AddStock.waiting_for_warehouse)
+@rate_limited
 async def process_warehouse(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await cancel_handler(message, state)
         return
         
@@ -2038,16 +2119,15 @@ async def process_warehouse_final(message: Message, state: FSMContext, warehouse
     try:
         user_data = await state.get_data()
         
-        user = await db.fetchone("SELECT id, company_name FROM users WHERE telegram_id = ?", (message.from_user.id,))
+        # Пользователь сохранен в состоянии при входе в /addstock
+        user_id = user_data.get('user_id')
+        company_name = user_data.get('company_name')
         
-        if user:
-            user_id, company_name = user[0], user[1]
+        if user_id:
             
             # Добавляем товар в базу
             await db.execute(
-                """INSERT INTO stock 
-                (user_id, sku, tyre_size, tyre_pattern, brand, country, qty_available, retail_price, wholesale_price, warehouse_location) 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                SQL_INSERT_STOCK,
                 (user_id, 
                  user_data['sku'], 
                  user_data['tyre_size'], 
@@ -2059,6 +2139,7 @@ async def process_warehouse_final(message: Message, state: FSMContext, warehouse
                  user_data['wholesale_price'], 
                  warehouse_location)
             )
+            stock_file_cache.delete(f"mystock_{user_id}")
             
             # Отправляем уведомления подписчикам
             notification_sent = False
@@ -2115,26 +2196,109 @@ async def process_warehouse_final(message: Message, state: FSMContext, warehouse
     
     await state.clear()
 
+@dp.message(Command("addstock_bulk"))
+@rate_limited
+async def cmd_addstock_bulk(message: Message, state: FSMContext):
+    """Добавление товаров одним сообщением вместо пошагового диалога"""
+    user = await get_cached_user(message.from_user.id)
+    
+    if not user:
+        await message.answer("Сначала зарегистрируйтесь с помощью /start")
+        return
+    
+    if user[1] != 'Дилер':
+        await message.answer("❌ Только дилеры могут добавлять товары на склад")
+        return
+    
+    stock_count = await db.get_user_stock_count(user[0])
+    if stock_count >= MAX_STOCK_ITEMS:
+        await message.answer(f"❌ Достигнут лимит товаров ({MAX_STOCK_ITEMS}). Удалите часть товаров чтобы добавить новые.")
+        return
+    
+    current_state = await state.get_state()
+    if current_state:
+        await message.answer(PENDING_OPERATION_MSG)
+        return
+        
+    await state.update_data(user_id=user[0])
+    await message.answer(ADD_STOCK_BULK_PROMPT, reply_markup=get_cancel_keyboard())
+    await state.set_state(AddStock.waiting_for_bulk)
+
+@dp.message(AddStock.waiting_for_bulk)
+@rate_limited
+async def process_addstock_bulk(message: Message, state: FSMContext):
+    if message.text in CANCEL_COMMANDS:
+        await cancel_handler(message, state)
+        return
+    
+    lines = [line for line in (message.text or "").splitlines() if line.strip()]
+    rows = []
+    errors = []
+    for number, line in enumerate(lines, 1):
+        try:
+            rows.append(parse_stock_line(line))
+        except ValueError as e:
+            errors.append(f"Строка {number}: {e}")
+    
+    # Сообщение принимается целиком или не принимается вовсе
+    if errors or not rows:
+        errors_text = "\n".join(errors[:10]) if errors else "нет данных"
+        await message.answer(f"❌ Ошибки:\n{errors_text}\n\nФормат: <code>{STOCK_LINE_FORMAT}</code>\nПопробуйте снова:")
+        return
+    
+    user_id = (await state.get_data()).get('user_id')
+    if not user_id:
+        await state.clear()
+        await message.answer("❌ Ошибка: пользователь не найден. Используйте /start для регистрации.")
+        return
+    
+    stock_count = await db.get_user_stock_count(user_id)
+    if stock_count + len(rows) > MAX_STOCK_ITEMS:
+        await message.answer(
+            f"❌ Превышен лимит товаров ({MAX_STOCK_ITEMS}). "
+            f"Можно добавить еще {max(MAX_STOCK_ITEMS - stock_count, 0)}. Попробуйте снова:"
+        )
+        return
+    
+    try:
+        # Один executemany и один коммит на все строки сообщения
+        await db.executemany(SQL_INSERT_STOCK, [(user_id,) + row for row in rows])
+        stock_file_cache.delete(f"mystock_{user_id}")
+        
+        for brand in {row[3] for row in rows}:
+            await send_notifications("brand", brand, f"Новые товары бренда {brand}")
+        for tyre_size in {row[1] for row in rows}:
+            await send_notifications("tyre_size", tyre_size, f"Новые товары размера {tyre_size}")
+        
+        await message.answer(f"✅ Добавлено товаров на склад: {len(rows)}")
+    except Exception as e:
+        logger.error(f"Bulk add stock error: {e}")
+        await message.answer(f"❌ Произошла ошибка при добавлении товара: {str(e)}")
+    
+    await state.clear()
+    user_role = await get_user_role(message.from_user.id)
+    await message.answer(
+        "Выберите действие:",
+        reply_markup=get_main_menu_keyboard(message.from_user.id, is_admin(message.from_user.id), user_role)
+    )
+
 # =============================================================================
 # АДМИН-ПАНЕЛЬ (БЕЗ ФУНКЦИИ "ВЕСЬ СКЛАД")
 # =============================================================================
 
 @dp.message(F.text == "🛠️ Админ")
 @dp.message(Command("admin"))
+@rate_limited
 async def cmd_admin(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     if not is_admin(message.from_user.id):
         await message.answer("❌ Доступ запрещен")
         return
     
     # Статистика системы
-    users_count = await db.fetchone("SELECT COUNT(*) FROM users")
-    stock_count = await db.fetchone("SELECT COUNT(*) FROM stock")
-    dealers_count = await db.fetchone("SELECT COUNT(*) FROM users WHERE role = 'Дилер'")
-    buyers_count = await db.fetchone("SELECT COUNT(*) FROM users WHERE role = 'Покупатель'")
+    users_count = await db.fetchone(SQL_COUNT_USERS)
+    stock_count = await db.fetchone(SQL_COUNT_STOCK)
+    dealers_count = await db.fetchone(SQL_COUNT_DEALERS)
+    buyers_count = await db.fetchone(SQL_COUNT_BUYERS)
     
     admin_text = (
         "🛠️ <b>Админ-панель Tyreterra</b>\n\n"
@@ -2186,10 +2350,10 @@ async def cmd_admin_stats(message: Message):
     
     try:
         # Базовая статистика
-        total_users = await db.fetchone("SELECT COUNT(*) FROM users")
-        total_stock = await db.fetchone("SELECT COUNT(*) FROM stock")
-        total_dealers = await db.fetchone("SELECT COUNT(*) FROM users WHERE role = 'Дилер'")
-        total_buyers = await db.fetchone("SELECT COUNT(*) FROM users WHERE role = 'Покупатель'")
+        total_users = await db.fetchone(SQL_COUNT_USERS)
+        total_stock = await db.fetchone(SQL_COUNT_STOCK)
+        total_dealers = await db.fetchone(SQL_COUNT_DEALERS)
+        total_buyers = await db.fetchone(SQL_COUNT_BUYERS)
         
         # Статистика по брендам
         brand_stats = await db.fetchall("""
@@ -2273,9 +2437,6 @@ async def cmd_admin_export(message: Message):
             ORDER BY s.date DESC
         """)
         
-        if not os.path.exists('temp_files'):
-            os.makedirs('temp_files')
-        
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
         # Создаем Excel файл с несколькими листами
@@ -2372,7 +2533,7 @@ async def process_sql_query(message: Message, state: FSMContext):
         await message.answer("❌ Доступ запрещен")
         return
         
-    if message.text == '/cancel' or message.text == '❌ Отмена':
+    if message.text in CANCEL_COMMANDS:
         await state.clear()
         await message.answer("❌ SQL запрос отменен", reply_markup=get_admin_keyboard())
         return
@@ -2413,6 +2574,9 @@ async def process_sql_query(message: Message, state: FSMContext):
         else:
             # Другие запросы - просто выполняем
             await db.execute(sql_query)
+            # Запрос мог поменять роли пользователей и товары
+            user_cache.clear()
+            stock_file_cache.clear()
             await message.answer("✅ Запрос выполнен успешно!")
         
         await state.clear()
@@ -2451,7 +2615,7 @@ async def cmd_admin_settings(message: Message):
     
     settings_text = (
         "⚙️ <b>Настройки системы</b>\n\n"
-        f"🔐 Администраторы: {', '.join(map(str, ADMIN_IDS))}\n"
+        f"🔐 Администраторы: {', '.join(map(str, sorted(ADMIN_IDS)))}\n"
         f"📦 Макс. товаров на пользователя: {MAX_STOCK_ITEMS}\n"
         f"📎 Макс. размер файла: {MAX_FILE_SIZE // 1024 // 1024} MB\n"
         f"💾 Путь к БД: {DB_PATH}\n\n"
@@ -2474,11 +2638,8 @@ async def cmd_admin_back_to_main(message: Message):
 # =============================================================================
 
 @dp.message(Registration.waiting_for_role)
+@rate_limited
 async def process_role(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     if message.text not in ["Дилер", "Покупатель"]:
         await message.answer("Пожалуйста, выберите роль из предложенных вариантов:")
         return
@@ -2488,21 +2649,15 @@ async def process_role(message: Message, state: FSMContext):
     await state.set_state(Registration.waiting_for_company)
 
 @dp.message(Registration.waiting_for_company)
+@rate_limited
 async def process_company(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     await state.update_data(company_name=message.text)
     await message.answer("Введите ИНН вашей компании (10 или 12 цифр):")
     await state.set_state(Registration.waiting_for_inn)
 
 @dp.message(Registration.waiting_for_inn)
+@rate_limited
 async def process_inn(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     inn = message.text.strip()
     if not validate_inn(inn):
         await message.answer("❌ Неверный формат ИНН. Введите 10 или 12 цифр:")
@@ -2513,11 +2668,8 @@ async def process_inn(message: Message, state: FSMContext):
     await state.set_state(Registration.waiting_for_phone)
 
 @dp.message(Registration.waiting_for_phone)
+@rate_limited
 async def process_phone(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     phone = message.text.strip()
     if not validate_phone(phone):
         await message.answer("❌ Неверный формат телефона. Введите номер в формате 89123456789:")
@@ -2528,11 +2680,8 @@ async def process_phone(message: Message, state: FSMContext):
     await state.set_state(Registration.waiting_for_email)
 
 @dp.message(Registration.waiting_for_email)
+@rate_limited
 async def process_email(message: Message, state: FSMContext):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     email = message.text.strip()
     if not validate_email(email):
         await message.answer("❌ Неверный формат email. Попробуйте снова:")
@@ -2547,6 +2696,7 @@ async def process_email(message: Message, state: FSMContext):
             (message.from_user.id, user_data['name'], user_data['company_name'], 
              user_data['inn'], user_data['phone'], email, user_data['role'])
         )
+        user_cache.delete(f"user_{message.from_user.id}")
         
         await message.answer(
             f"✅ Регистрация завершена!\n\n"
@@ -2567,11 +2717,8 @@ async def process_email(message: Message, state: FSMContext):
     await state.clear()
 
 @dp.message()
+@rate_limited
 async def unknown_message(message: Message):
-    if await check_rate_limit(message.from_user.id):
-        await message.answer("⚠️ Слишком много запросов. Подождите немного.")
-        return
-        
     user_role = await get_user_role(message.from_user.id)
     is_admin_user = is_admin(message.from_user.id)
     await message.answer(
@@ -2588,6 +2735,9 @@ async def periodic_cleanup():
         try:
             await asyncio.sleep(3600)
             cleanup_temp_files()
+            # Записи удаляются в get только при повторном запросе того же ключа
+            user_cache.purge_expired()
+            stock_file_cache.purge_expired()
             
             # Также очищаем папку uploads
             current_time = time.time()
@@ -2608,10 +2758,6 @@ async def main():
     await db.init_db()
     logger.info("✅ База данных инициализирована")
     
-    for folder in ['temp_files', 'uploads']:
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-    
     asyncio.create_task(periodic_cleanup())
     logger.info("✅ Фоновая очистка временных файлов запущена")
     